@@ -0,0 +1,82 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Union
+import numpy as np
+
+
+class SemanticAnswerCache():
+    """
+    Cache answers by the embedding of the standalone question. A question is answered from the cache when
+    an earlier one asked against the same knowledge base and model version is at least `threshold` similar
+    (cosine). Entries expire after `ttl` seconds and the least recently used ones are evicted beyond
+    `max_entries`.
+    """
+
+    def __init__(self, logger, threshold: float = 0.95, ttl: int = 3600, max_entries: int = 512,
+                 enabled: bool = True):
+        self.logger = logger
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # key: (version, vector, question, answer, reasoning, created)
+        self._entries: OrderedDict[int, Tuple[str, np.ndarray, str, str, str, float]] = OrderedDict()
+        self._next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        return v / max(float(np.linalg.norm(v)), 1e-12)
+
+    def _expire(self, now: float):
+        for key in [k for k, e in self._entries.items() if now - e[5] > self.ttl]:
+            del self._entries[key]
+
+    def lookup(self, version: str, vector: List[float]) -> Tuple[str, str] | None:
+        """
+        Return the cached (answer, reasoning) for the most similar question, if similar enough.
+        """
+        v = self._normalize(vector)
+        with self._lock:
+            self._expire(time.time())
+            keys = [k for k, e in self._entries.items() if e[0] == version]
+            if keys:
+                similarities = np.stack([self._entries[k][1] for k in keys]) @ v
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    _, _, question, answer, reasoning, _ = self._entries[keys[best]]
+                    self.logger.info(f'Answered from the cache: "{question}" '
+                                     f'(similarity {similarities[best]:.3f})')
+                    return answer, reasoning
+            self.misses += 1
+            return None
+
+    def put(self, version: str, vector: List[float], question: str, answer: str, reasoning: str):
+        with self._lock:
+            self._entries[self._next_key] = (version, self._normalize(vector), question, answer, reasoning,
+                                             time.time())
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, version: str):
+        """
+        Drop the answers of a version, e.g. after the knowledge base or the model has changed.
+        """
+        with self._lock:
+            stale = [k for k, e in self._entries.items() if e[0] == version]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            self.logger.info(f'Invalidated {len(stale)} cached answer(s).')
+
+    def stats(self) -> Dict[str, Union[bool, int, float]]:
+        lookups = self.hits + self.misses
+        return {'enabled': self.enabled, 'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
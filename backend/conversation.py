@@ -0,0 +1,159 @@
+import re
+from contextlib import nullcontext
+from typing import List, Dict, Tuple, AsyncIterator
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable
+from retrievers import HybridRetriever
+
+
+def strip_think(text: str) -> str:
+    return re.sub(r'<think>[\s\S]*?</think>', '', text).strip()
+
+
+class ThinkSplitter():
+    """
+    Split the output of a reasoning model into reasoning, i.e. what is enclosed by <think> and </think>,
+    and answer while it is streamed in. Text which might be the beginning of a tag split across chunks
+    is held back until the next chunk tells.
+    """
+    REASONING = 'reasoning'
+    ANSWER = 'answer'
+    _tags = {ANSWER: '<think>', REASONING: '</think>'}
+
+    def __init__(self):
+        self.state = self.ANSWER
+        self._pending = ''
+        self._at_start = True  # Leading whitespace of a part is dropped.
+
+    def _emit(self, text: str, parts: List[Tuple[str, str]]):
+        if self._at_start:
+            text = text.lstrip()
+        if text:
+            self._at_start = False
+            parts.append((self.state, text))
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """
+        Return the (state, text) parts the chunk completes.
+        """
+        parts = []
+        text = self._pending + chunk
+        self._pending = ''
+        while text:
+            tag = self._tags[self.state]
+            pos = text.find(tag)
+            if pos >= 0:
+                self._emit(text[:pos], parts)
+                text = text[pos + len(tag):]
+                self.state = self.REASONING if self.state == self.ANSWER else self.ANSWER
+                self._at_start = True
+                continue
+            # Hold back a tail which the next chunk may complete to the tag.
+            keep = next((n for n in range(min(len(tag) - 1, len(text)), 0, -1) if tag.startswith(text[-n:])), 0)
+            self._emit(text[:len(text) - keep], parts)
+            self._pending = text[len(text) - keep:]
+            break
+        return parts
+
+    def finish(self) -> List[Tuple[str, str]]:
+        parts = []
+        self._emit(self._pending, parts)
+        self._pending = ''
+        return parts
+
+    @classmethod
+    def split(cls, text: str) -> Tuple[str, str]:
+        """
+        Split a complete output into (answer, reasoning). Several reasoning blocks are joined by newlines.
+        """
+        splitter = cls()
+        answer, reasoning = [], []
+        for state, part in splitter.feed(text) + splitter.finish():
+            (reasoning if state == cls.REASONING else answer).append(part)
+        return ''.join(answer).strip(), '\n'.join(r.strip() for r in reasoning if r.strip())
+
+
+# Words referring back to the conversation. Questions without any are taken as standalone already.
+_REFERENCES = re.compile(r'[它他她这那其此该]|上述|上面|前面|刚才|之前|继续|还有|另外|然后|呢[?？]?$'
+                         r'|\b(?:it|its|this|that|these|those|they|them|their|he|she|him|her|above|previous'
+                         r'|again|more|else|also)\b', re.IGNORECASE)
+_MIN_STANDALONE_LENGTH = 6  # Shorter questions like "为什么？" lean on the history.
+
+
+def is_self_contained(question: str) -> bool:
+    question = question.strip()
+    return len(question) >= _MIN_STANDALONE_LENGTH and not _REFERENCES.search(question)
+
+
+class RagPipeline():
+    """
+    Condense the question with the chat history, retrieve context for the standalone question and answer.
+    The steps run one by one instead of as one chain, so that the caller can answer from a cache in between
+    and keep the chat history itself. Condensing may run on a smaller model than answering, and is skipped
+    for questions which make sense on their own if `bypass` is set.
+
+    `version` identifies the knowledge base and the model setting the answers depend on. It is None for a
+    pipeline serving a knowledge base still being ingested, whose answers shall not be cached.
+
+    The steps are async and run on the server loop, the only one the async clients of the providers are used on.
+    Given a scheduler.RequestScheduler, the steps calling an LLM take a slot of its provider first.
+    Given token_budget.PromptPackers, history and context are cut to the prompt budget of either model.
+    """
+
+    def __init__(self, condense_chain: Runnable, retriever: HybridRetriever, answer_chain: Runnable,
+                 embeddings: Embeddings, version: str | None, bypass: bool = True, scheduler=None,
+                 llm_provider: str = '', condenser_provider: str = '', answer_packer=None, condense_packer=None):
+        self.condense_chain = condense_chain
+        self.retriever = retriever
+        self.answer_chain = answer_chain
+        self.embeddings = embeddings
+        self.version = version
+        self.bypass = bypass
+        self.scheduler = scheduler
+        self.llm_provider = llm_provider
+        self.condenser_provider = condenser_provider or llm_provider
+        self.answer_packer = answer_packer
+        self.condense_packer = condense_packer
+
+    def _slot(self, provider: str):
+        return self.scheduler.slot(provider) if self.scheduler else nullcontext()
+
+    def is_standalone(self, question: str, history: List[BaseMessage]) -> bool:
+        """
+        Whether the question is taken as it is, i.e. without condensing it with the history.
+        """
+        return not history or (self.bypass and is_self_contained(question))
+
+    def _condense_input(self, question: str, history: List[BaseMessage]) -> Dict:
+        if self.condense_packer:
+            history, _, _ = self.condense_packer.pack(question, history)
+        return {'input': question, 'history': history}
+
+    def _answer_input(self, question: str, history: List[BaseMessage], context: List[Document]) -> Dict:
+        if self.answer_packer:
+            history, context, _ = self.answer_packer.pack(question, history, context)
+        return {'input': question, 'history': history, 'context': context}
+
+    async def acondense(self, question: str, history: List[BaseMessage]) -> str:
+        if self.is_standalone(question, history):
+            return question
+        async with self._slot(self.condenser_provider):
+            return strip_think(await self.condense_chain.ainvoke(self._condense_input(question, history)))
+
+    async def aretrieve(self, standalone_question: str, query_vector: List[float] | None = None) -> List[Document]:
+        # A question embedded already, e.g. for the answer cache, is searched by its vector.
+        if query_vector is not None:
+            return await self.retriever.aget_by_vector(standalone_question, query_vector)
+        return await self.retriever.ainvoke(standalone_question)
+
+    async def aanswer(self, question: str, history: List[BaseMessage], context: List[Document]) -> str:
+        async with self._slot(self.llm_provider):
+            return await self.answer_chain.ainvoke(self._answer_input(question, history, context))
+
+    async def astream_answer(self, question: str, history: List[BaseMessage],
+                             context: List[Document]) -> AsyncIterator[str]:
+        async with self._slot(self.llm_provider):
+            async for chunk in self.answer_chain.astream(self._answer_input(question, history, context)):
+                yield chunk
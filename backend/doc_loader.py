@@ -0,0 +1,197 @@
+import os
+import re
+import csv
+from typing import List, Tuple, Iterator
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
+from token_budget import count_tokens
+
+# Functions in this module run inside worker processes of ModelConfig. Keep them free of
+# application state so that they can be pickled and imported without side effects.
+# Loaders are imported by the file type that needs them.
+
+DOC_TYPES = {'.txt': 'text', '.md': 'markdown', '.pdf': 'PDF', '.docx': 'Word', '.csv': 'CSV'}
+# Loader metadata kept on every chunk. The rest (e.g. PDF producer, dates) only bloats the docstore.
+CHUNK_METADATA = ('source', 'page', 'row', 'section', 'line', 'start_index')
+
+_MD_HEADING = re.compile(r'^ {0,3}(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$')
+_MD_SETEXT = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+_MD_FENCE = re.compile(r'^ {0,3}(```|~~~)')
+
+
+def pdf_page_count(file_path: str) -> int:
+    import pymupdf
+    with pymupdf.open(file_path) as pdf:
+        return pdf.page_count
+
+
+def csv_parts(file_path: str, rows_per_part: int) -> List[Tuple[int, int, int]]:
+    """
+    Scan a CSV file once and return its row batches as (file position, first row, number of rows),
+    so that every batch can be read on its own without parsing the rows before it.
+    """
+    parts = []
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        lines = iter(f.readline, '')
+        next(csv.reader(lines), None)  # Header
+        position, first_row, num_rows = f.tell(), 0, 0
+        for _ in csv.reader(lines):
+            num_rows += 1
+            if num_rows == rows_per_part:
+                parts.append((position, first_row, num_rows))
+                position, first_row, num_rows = f.tell(), first_row + num_rows, 0
+        if num_rows > 0:
+            parts.append((position, first_row, num_rows))
+    return parts
+
+
+def _iter_csv_rows(file_path: str, part: Tuple[int, int, int] | None) -> Iterator[Document]:
+    # Rows are rendered the same way as CSVLoader does, i.e. one "column: value" line per column.
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        lines = iter(f.readline, '')
+        fieldnames = next(csv.reader(lines), [])
+        first_row, num_rows = 0, None
+        if part:
+            position, first_row, num_rows = part
+            f.seek(position)
+        for i, row in enumerate(csv.DictReader(lines, fieldnames=fieldnames)):
+            if num_rows is not None and i >= num_rows:
+                break
+            content = '\n'.join(
+                f"{k.strip() if k is not None else k}: "
+                f"{v.strip() if isinstance(v, str) else ','.join(map(str.strip, v)) if isinstance(v, list) else v}"
+                for k, v in row.items())
+            yield Document(page_content=content, metadata={'source': file_path, 'row': first_row + i})
+
+
+def _iter_pdf_pages(file_path: str, part: Tuple[int, int] | None) -> Iterator[Document]:
+    import pymupdf
+    with pymupdf.open(file_path) as pdf:
+        for page_no in range(*(part or (0, pdf.page_count))):
+            yield Document(page_content=pdf[page_no].get_text(),
+                           metadata={'source': file_path, 'page': page_no})
+
+
+def _markdown_encoding(file_path: str) -> str:
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for _ in f:
+                pass
+        return 'utf-8'
+    except UnicodeDecodeError:
+        from langchain_community.document_loaders.helpers import detect_file_encodings
+        return detect_file_encodings(file_path)[0].encoding
+
+
+def _set_heading(headings: List[str], level: int, title: str):
+    del headings[level - 1:]
+    headings.extend([''] * (level - 1 - len(headings)))
+    headings.append(title)
+
+
+def iter_markdown_sections(file_path: str) -> Iterator[Document]:
+    """
+    Stream a Markdown file line by line and yield one document per section, i.e. a heading and its body
+    up to the next heading. The heading hierarchy is kept as metadata, e.g. {'section': 'FAQ > Network'},
+    along with the line and the character offset the section starts at. Headings inside fenced code
+    blocks are ignored.
+    """
+    headings: List[str] = []
+    lines: List[str] = []
+    start_line, start_offset, offset = 1, 0, 0
+    fence = None
+
+    def section() -> Document:
+        return Document(page_content=''.join(lines),
+                        metadata={'source': file_path, 'section': ' > '.join(h for h in headings if h),
+                                  'line': start_line, 'offset': start_offset})
+
+    with open(file_path, 'r', encoding=_markdown_encoding(file_path), newline='') as f:
+        for line_no, line in enumerate(f, start=1):
+            text = line.rstrip('\r\n')
+            m_fence = _MD_FENCE.match(text)
+            if m_fence and (fence is None or m_fence.group(1) == fence):
+                fence = m_fence.group(1) if fence is None else None
+            m_heading = _MD_HEADING.match(text) if fence is None else None
+            m_setext = _MD_SETEXT.match(text) if fence is None and lines else None
+            if m_setext and lines[-1].strip() and not _MD_HEADING.match(lines[-1]):
+                # Setext heading: the previous line is the title and this line underlines it.
+                title = lines.pop()
+                if ''.join(lines).strip():
+                    yield section()
+                _set_heading(headings, 1 if m_setext.group(1).startswith('=') else 2, title.strip())
+                start_line, start_offset = line_no - 1, offset - len(title)
+                lines = [title, line]
+            elif m_heading:
+                if ''.join(lines).strip():
+                    yield section()
+                _set_heading(headings, len(m_heading.group(1)), m_heading.group(2).strip())
+                start_line, start_offset = line_no, offset
+                lines = [line]
+            else:
+                lines.append(line)
+            offset += len(line)
+        if ''.join(lines).strip():
+            yield section()
+
+
+def iter_document(file_path: str, part: Tuple[int, ...] | None = None) -> Iterator[Document]:
+    """
+    Yield a document piece by piece: Markdown by section, PDF by page and CSV by row. A part restricts
+    the pieces to a page range (start, end) of a PDF or a row batch of a CSV as given by csv_parts().
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.md':
+        yield from iter_markdown_sections(file_path)
+    elif ext == '.txt':
+        from langchain_community.document_loaders import TextLoader
+        yield from TextLoader(file_path, encoding='utf-8', autodetect_encoding=True).lazy_load()
+    elif ext == '.pdf':
+        yield from _iter_pdf_pages(file_path, part)
+    elif ext == '.docx':
+        from langchain_community.document_loaders.word_document import Docx2txtLoader
+        yield from Docx2txtLoader(file_path=file_path).lazy_load()
+    elif ext == '.csv':
+        yield from _iter_csv_rows(file_path, part)
+    else:
+        raise RuntimeWarning(f'File type {ext} is not supported yet.')
+
+
+def iter_chunks(file_path: str, chunk_size: int, chunk_overlap: int,
+                part: Tuple[int, ...] | None = None) -> Iterator[Document]:
+    """
+    Load a document and split it in a single pass. Every chunk keeps the page (PDF) or row (CSV)
+    it came from and its character offset in there as metadata, as well as its token count.
+    """
+    if file_path.lower().endswith('.md'):
+        # Sections are split further on Markdown structure (paragraphs, lists, code blocks) only if too long.
+        text_splitter = RecursiveCharacterTextSplitter.from_language(
+            Language.MARKDOWN,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            add_start_index=True,
+        )
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            add_start_index=True,
+        )
+    for document in iter_document(file_path, part):
+        for chunk in text_splitter.split_documents([document]):
+            if 'offset' in chunk.metadata:
+                # Make the offset of a section chunk relative to the whole file.
+                chunk.metadata['start_index'] += chunk.metadata['offset']
+            chunk.metadata = {k: v for k, v in chunk.metadata.items() if k in CHUNK_METADATA}
+            # Counted once here, so that prompts are packed without tokenizing retrieved chunks again.
+            chunk.metadata['n_tokens'] = count_tokens(chunk.page_content)
+            yield chunk
+
+
+def split_document(file_path: str, chunk_size: int, chunk_overlap: int,
+                   part: Tuple[int, ...] | None = None) -> List[Document]:
+    chunks = list(iter_chunks(file_path, chunk_size, chunk_overlap, part))
+    assert len(chunks) > 0 or part, f'No content is loaded yet. Please check document {file_path}'
+    return chunks
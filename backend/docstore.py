@@ -0,0 +1,171 @@
+import os
+import json
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Union
+from langchain_community.docstore.base import Docstore, AddableMixin
+from langchain_core.documents import Document
+
+
+class SqliteDocstore(Docstore):
+    """
+    Read-only docstore kept in SQLite next to a persisted index. Chunks are fetched by ID when a search
+    returns them, and a small LRU keeps the hot ones in memory. Rows are ordered by their position in the
+    vector index, so the same file also maps index positions to chunk IDs (see PositionIdMap).
+    """
+
+    def __init__(self, db_path: str, cache_size: int = 1024):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        # Opened read-only, so any number of processes can share the file.
+        self._conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, Document] = OrderedDict()
+
+    @staticmethod
+    def write(db_path: str, documents: Iterable[Document]):
+        """
+        Write the chunks, given in the order of their index positions, to a new docstore file.
+        """
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute('CREATE TABLE docs (pos INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, '
+                         'text TEXT NOT NULL, metadata TEXT NOT NULL)')
+            conn.executemany('INSERT INTO docs VALUES (?, ?, ?, ?)',
+                             ((pos, doc.id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+                              for pos, doc in enumerate(documents)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _query(self, sql: str, params=()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def search(self, search: str) -> Union[str, Document]:
+        with self._lock:
+            doc = self._cache.get(search)
+            if doc is not None:
+                self._cache.move_to_end(search)
+                return doc
+        rows = self._query('SELECT text, metadata FROM docs WHERE id=?', (search,))
+        if not rows:
+            return f"ID {search} not found."
+        doc = Document(id=search, page_content=rows[0][0], metadata=json.loads(rows[0][1]))
+        with self._lock:
+            self._cache[search] = doc
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return doc
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM docs')[0][0]
+
+    def iter_documents(self, batch_size: int = 1000) -> Iterator[Document]:
+        """
+        Stream all chunks in index order, bypassing the LRU.
+        """
+        last = -1
+        while True:
+            rows = self._query('SELECT pos, id, text, metadata FROM docs WHERE pos>? ORDER BY pos LIMIT ?',
+                               (last, batch_size))
+            if not rows:
+                return
+            for pos, chunk_id, text, metadata in rows:
+                yield Document(id=chunk_id, page_content=text, metadata=json.loads(metadata))
+            last = rows[-1][0]
+
+    def close(self):
+        self._conn.close()
+
+
+def _discard(conn: sqlite3.Connection, db_path: str):
+    conn.close()
+    try:
+        os.remove(db_path)
+    except OSError:
+        pass
+
+
+class StagingDocstore(Docstore, AddableMixin):
+    """
+    Writable docstore of an index being updated, kept in a scratch SQLite file rather than in memory. It starts
+    as a copy of the chunks of `source`, the docstore file of the persisted index, if given. The file is removed
+    once the docstore is let go, i.e. when the index is persisted and no request searches it any more.
+    """
+
+    def __init__(self, db_path: str, source: str | None = None):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._finalizer = weakref.finalize(self, _discard, self._conn, db_path)
+        self._lock = threading.Lock()
+        # A scratch file. It is of no use after a crash anyway.
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('DROP TABLE IF EXISTS docs')
+        self._conn.execute('CREATE TABLE docs (id TEXT PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)')
+        if source:
+            self._conn.execute('ATTACH DATABASE ? AS source', (source,))
+            self._conn.execute('INSERT INTO docs SELECT id, text, metadata FROM source.docs ORDER BY pos')
+            self._conn.commit()
+            self._conn.execute('DETACH DATABASE source')
+        self._conn.commit()
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                                   [(chunk_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+                                    for chunk_id, doc in texts.items()])
+            self._conn.commit()
+
+    def search(self, search: str) -> Union[str, Document]:
+        with self._lock:
+            row = self._conn.execute('SELECT text, metadata FROM docs WHERE id=?', (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            self._conn.executemany('DELETE FROM docs WHERE id=?', [(chunk_id,) for chunk_id in ids])
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+
+class PositionIdMap(Mapping):
+    """
+    Read-only index position -> chunk ID mapping backed by a SqliteDocstore, to be used as
+    index_to_docstore_id of a FAISS vector store without holding every ID in memory.
+    """
+
+    def __init__(self, docstore: SqliteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, pos: int) -> str:
+        rows = self.docstore._query('SELECT id FROM docs WHERE pos=?', (int(pos),))
+        if not rows:
+            raise KeyError(pos)
+        return rows[0][0]
+
+    def __len__(self):
+        return len(self.docstore)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self)))
+
+    def values(self) -> List[str]:
+        return [row[0] for row in self.docstore._query('SELECT id FROM docs ORDER BY pos')]
+
+
+def iter_documents(docstore: Docstore, index_to_docstore_id: Dict[int, str]) -> Iterator[Document]:
+    if isinstance(docstore, SqliteDocstore):
+        yield from docstore.iter_documents()
+    else:
+        for chunk_id in index_to_docstore_id.values():
+            yield docstore.search(chunk_id)
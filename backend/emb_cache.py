@@ -0,0 +1,142 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache():
+    """
+    Durable content-addressed cache of embeddings, i.e. (provider, model, chunk text hash) -> vector.
+    Vectors are kept as float32 blobs in SQLite. The least recently used ones are evicted once the
+    total size exceeds the limit.
+    """
+    file_name = "emb_cache.sqlite"
+
+    def __init__(self, cache_dir, logger, max_mb: int = 512):
+        self.logger = logger
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, self.file_name)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                           'provider TEXT NOT NULL, model TEXT NOT NULL, text_hash TEXT NOT NULL, '
+                           'vector BLOB NOT NULL, last_used INTEGER NOT NULL, '
+                           'PRIMARY KEY (provider, model, text_hash))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)')
+        self._conn.commit()
+        # Bytes of vectors cached. Counted once here and kept up to date by put_many and _evict.
+        self._size = self._conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, provider: str, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        now = int(time.time())
+        with self._lock:
+            # Stay well below SQLite's limit of host parameters per statement.
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                marks = ','.join('?' * len(part))
+                rows = self._conn.execute(f'SELECT text_hash, vector FROM embeddings '
+                                          f'WHERE provider=? AND model=? AND text_hash IN ({marks})',
+                                          [provider, model, *part]).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+                self._conn.execute(f'UPDATE embeddings SET last_used=? '
+                                   f'WHERE provider=? AND model=? AND text_hash IN ({marks})',
+                                   [now, provider, model, *part])
+            self._conn.commit()
+        return found
+
+    def put_many(self, provider: str, model: str, items: Dict[str, List[float]]):
+        if not items:
+            return
+        now = int(time.time())
+        rows = [(provider, model, h, np.asarray(v, dtype=np.float32).tobytes(), now) for h, v in items.items()]
+        with self._lock:
+            # Vectors replaced, e.g. embedded by two rebuilds at the same time, are not counted twice.
+            hashes = list(items)
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                marks = ','.join('?' * len(part))
+                self._size -= self._conn.execute(f'SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings '
+                                                 f'WHERE provider=? AND model=? AND text_hash IN ({marks})',
+                                                 [provider, model, *part]).fetchone()[0]
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+            self._size += sum(len(row[3]) for row in rows)
+            self._evict()
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        # Evict down to 90% of the limit so that eviction does not run on every insert.
+        excess = self._size - int(self.max_bytes * 0.9)
+        victims = []
+        for rowid, size in self._conn.execute('SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used'):
+            if excess <= 0:
+                break
+            victims.append((rowid,))
+            excess -= size
+            self._size -= size
+        self._conn.executemany('DELETE FROM embeddings WHERE rowid=?', victims)
+        self._conn.commit()
+        self.logger.info(f'Evicted {len(victims)} embedding(s) from the embedding cache.')
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wrap an embedding client so that document embeddings are looked up in the EmbeddingCache first.
+    Only the texts never embedded before with the same provider and model reach the client.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, provider: str, model: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.provider = (provider or '').upper()
+        self.model = model or ''
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, texts: List[str]):
+        hashes = [self.cache.text_hash(t) for t in texts]
+        found = self.cache.get_many(self.provider, self.model, list(set(hashes)))
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found:
+                missing.setdefault(h, t)
+        self.hits += len(texts) - sum(1 for h in hashes if h not in found)
+        self.misses += len(missing)
+        return hashes, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, missing = self._lookup(texts)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.provider, self.model, fresh)
+            found.update(fresh)
+        return [found[h] for h in hashes]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, missing = self._lookup(texts)
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.provider, self.model, fresh)
+            found.update(fresh)
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
@@ -0,0 +1,83 @@
+import asyncio
+import importlib.util
+import threading
+import weakref
+from typing import Dict, Tuple
+import httpx
+
+
+class _LoopBoundAsyncClient(httpx.AsyncClient):
+    """
+    An async client with one connection pool per event loop. The connections of an httpx async client belong
+    to the loop they were opened on, so every request is sent through the client of the loop it runs on.
+    """
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._options = options
+        self._loop_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = \
+            weakref.WeakKeyDictionary()
+        self._loop_lock = threading.Lock()
+
+    def _loop_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._loop_lock:
+            client = self._loop_clients.get(loop)
+            if client is None:
+                client = self._loop_clients[loop] = httpx.AsyncClient(**self._options)
+            return client
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self._loop_client().send(request, **kwargs)
+
+    async def aclose(self):
+        # The clients of other loops are dropped with their loops.
+        with self._loop_lock:
+            client = self._loop_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+        await super().aclose()
+
+
+class HttpClientPool():
+    """
+    One sync and one async httpx client per provider, shared by all its LLM and embedding clients and kept
+    across rebuilds. Connections are kept alive between requests, so that a request to a remote provider
+    does not pay for a TCP and TLS handshake each time. HTTP/2 is negotiated where the endpoint offers it
+    if the h2 package is installed. The async client keeps a connection pool per event loop.
+
+    The OpenAI compatible clients take the httpx clients as they are. The Ollama clients build their own
+    and only take the limits, see `client_kwargs`. Their async client is only used on the server loop.
+    """
+
+    def __init__(self, logger, max_connections: int = 20, max_keepalive: int = 10, keepalive_expiry: float = 60,
+                 http2: bool = True, timeout: float = 600, connect_timeout: float = 10):
+        self.logger = logger
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        if http2 and not self.http2:
+            self.logger.info('Connect with HTTP/1.1 only as the h2 package is not installed.')
+        self._clients: Dict[str, Tuple[httpx.Client, httpx.AsyncClient]] = {}
+        self._lock = threading.Lock()
+
+    def clients(self, provider: str) -> Tuple[httpx.Client, httpx.AsyncClient]:
+        provider = provider.upper()
+        with self._lock:
+            if provider not in self._clients:
+                options = dict(limits=self.limits, timeout=self.timeout, http2=self.http2, follow_redirects=True)
+                self._clients[provider] = (httpx.Client(**options), _LoopBoundAsyncClient(**options))
+                self.logger.debug(f'Open the HTTP connection pool of {provider}.')
+            return self._clients[provider]
+
+    def client_kwargs(self) -> Dict[str, httpx.Limits]:
+        # Ollama is served locally over HTTP/1.1. Its clients time out as Ollama sees fit.
+        return {'limits': self.limits}
+
+    async def aclose(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client, async_client in clients:
+            client.close()
+            await async_client.aclose()
@@ -1,16 +1,19 @@
+import time
+startup_started = time.perf_counter()
 import os, sys, re
+import json
 import argparse
 # import shutil
 import pypandoc
 import tempfile
 import chardet
 
-import psutil
 from PIL import Image
 import yaml
 from pydantic import BaseModel
 import uvicorn
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Response
+from fastapi.responses import StreamingResponse
 # import tomlkit  # Import tomlkit for round-trip parsing
 from typing import List, Dict, Union
 from starlette.middleware.cors import CORSMiddleware
@@ -19,19 +22,28 @@ from PyQt5.QtWidgets import QApplication, QSystemTrayIcon, QMenu, QAction
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import QMetaObject, Qt
 import threading
+import multiprocessing
 import asyncio
 import webbrowser
 # import signal
-import win32gui, win32api, win32con
+import win32gui, win32api, win32con, win32event, winerror
 from win32con import WS_CAPTION
 
-from utils import check_model_avail
+from utils import check_model_avail, PhaseTimer
+from scheduler import SchedulerBusy
+from knowledge_base import KnowledgeBaseUnloaded
 # import win32console  # Import win32console to access the console buffer
 from logging_config import setup_logging
 import time
 from ollama_setting import OllamaSetting
 
 
+# Documents are parsed in worker processes. Let a frozen worker run its task instead of the application.
+multiprocessing.freeze_support()
+# Worker processes import this module as __mp_main__ as well. They must neither quit on the single-instance
+# check nor build the service, see init_service.
+is_primary_process = multiprocessing.parent_process() is None
+
 if getattr(sys, 'frozen', False):
     # If it is a PyInstaller packaged executable
     app_root = os.path.abspath(os.path.dirname(sys.executable))
@@ -44,24 +56,40 @@ logger = setup_logging(logfile=os.path.join(app_root, 'run.log'))
 
 logger.info(f'python version : {sys.version}')
 
-current_process = psutil.Process(os.getpid())
-process_name = os.path.normcase(current_process.name())
-cnt_found = 0
-for proc in psutil.process_iter(['name']):
-    p_name = os.path.normcase(proc.info['name'])
-    if p_name == process_name and proc.pid != current_process.pid:
-        logger.warning(f'Another {p_name} instance(PID={proc.pid}) is running. Exiting...')
+phase_timer = PhaseTimer(logger, started=startup_started)
+phase_timer.add('imports', time.perf_counter() - startup_started)
+
+# Single instance check. A named mutex costs the same no matter how many processes are running.
+mutex = None
+if is_primary_process:
+    mutex = win32event.CreateMutex(None, False, 'unichat_single_instance')
+    if win32api.GetLastError() == winerror.ERROR_ALREADY_EXISTS:
+        logger.warning(f'Another unichat instance is running. Exiting...')
         sys.exit(0)
 
 
 logger.info(f'APP ROOT: {app_root}')
 
 
-from rag_service import RagService
-rag_service = RagService(app_root, logger)
-LOCAL_DOCS_DIR = rag_service.modconfig.local_docs_dir()
-logger.info(f'LOCAL_DOCS_DIR: {LOCAL_DOCS_DIR }')
-rag_service.setup_service(LOCAL_DOCS_DIR)
+rag_service = None
+LOCAL_DOCS_DIR = None
+
+
+def init_service():
+    """
+    Build the service and start building the knowledge base. This runs in the application process only.
+    """
+    global rag_service, LOCAL_DOCS_DIR
+    with phase_timer.phase('imports'):
+        from rag_service import RagService
+    with phase_timer.phase('config'):
+        rag_service = RagService(app_root, logger)
+    LOCAL_DOCS_DIR = rag_service.modconfig.local_docs_dir()
+    logger.info(f'LOCAL_DOCS_DIR: {LOCAL_DOCS_DIR }')
+    # The knowledge base is built in the background. The server binds right away and /readyz tells when
+    # questions can be answered.
+    rag_service.start_service(LOCAL_DOCS_DIR)
+
 
 try:
     # Open and read the .yml file
@@ -74,7 +102,6 @@ except FileNotFoundError:
     logger.warning('Version file not found. Using "Unknown" as version number.')
 
 user_url = "http://localhost:63342/unichat/frontend/index.html"
-print(f'If the chat page is not opened within few seconds, please click the link {user_url} instead.')
 
 # Create FastAPI application for API service
 app = FastAPI()
@@ -94,6 +121,7 @@ app.add_middleware(
 class QuestionRequest(BaseModel):
     question: str
     session_id: str
+    kb_id: str | None = None  # The default knowledge base if None
 
 
 # Define response model
@@ -102,9 +130,48 @@ class AnswerResponse(BaseModel):
     answer: str
 
 
+WARMUP_RETRY_AFTER = 5  # seconds
+
+
+def not_ready(kb_id: str | None = None) -> HTTPException:
+    status = rag_service.service_status(kb_id)
+    if status['state'] == 'failed':
+        return HTTPException(status_code=503, detail=f"The knowledge base failed to build: {status['message']}")
+    if status['state'] == 'running':
+        detail = f"The knowledge base is warming up ({status['progress']:.0%}). Please retry later."
+    else:
+        detail = "The knowledge base is not loaded. It is loaded on the next question."
+    return HTTPException(status_code=503, detail=detail, headers={'Retry-After': str(WARMUP_RETRY_AFTER)})
+
+
+def assert_service_ready(kb_id: str | None = None):
+    # Knowledge bases other than the default one are loaded on first use, warming up meanwhile.
+    try:
+        if rag_service.ensure_loaded(kb_id):
+            return
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Knowledge base {kb_id} does not exist.")
+    raise not_ready(kb_id)
+
+
+def too_busy(busy: SchedulerBusy) -> HTTPException:
+    return HTTPException(status_code=429,
+                         detail=f"Too many questions are waiting for {busy.provider}. Please retry later.",
+                         headers={'Retry-After': str(busy.retry_after), 'X-Queue-Position': str(busy.position)})
+
+
+def assert_capacity(kb_id: str | None = None):
+    try:
+        rag_service.check_capacity(kb_id)
+    except SchedulerBusy as busy:
+        raise too_busy(busy)
+
+
 # Provide query API http://127.0.0.1:8000/ask
 @app.post("/ask", response_model=AnswerResponse)
 async def ask_question(request: QuestionRequest):
+    assert_service_ready(request.kb_id)
+    assert_capacity(request.kb_id)
     try:
         # Get user question
         user_question = request.question
@@ -113,11 +180,16 @@ async def ask_question(request: QuestionRequest):
 
         # Build answer through RAG chain
         # answer = qa_chain.run(user_question)
-        ai_answering, ai_reasoning = rag_service.__ask__(session_id, user_question)
+        ai_answering, ai_reasoning = await rag_service.__ask__(session_id, user_question, request.kb_id)
 
         final_answer = AnswerResponse(think=ai_reasoning, answer=ai_answering)
         logger.debug(f'answer:{ai_answering}')
         return final_answer
+    except SchedulerBusy as busy:
+        raise too_busy(busy)
+    except KnowledgeBaseUnloaded:
+        # Unloaded to save memory after it was found ready. The next request loads it again.
+        raise not_ready(request.kb_id)
     except asyncio.exceptions.CancelledError:
         logger.info("Async task cancelled during ask_question. Ignoring...")
         raise HTTPException(status_code=503, detail="Service is temporarily unavailable.")
@@ -131,11 +203,118 @@ async def ask_question(request: QuestionRequest):
         raise HTTPException(status_code=status_code, detail=str(ee))
 
 
+def server_sent_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Provide streaming query API http://127.0.0.1:8000/ask/stream
+# Reasoning and answer are sent as "reasoning" and "answer" events while the LLM generates them,
+# followed by a "done" event. Failures after the stream has started are reported as an "error" event.
+@app.post("/ask/stream")
+async def ask_question_stream(request: QuestionRequest):
+    assert_service_ready(request.kb_id)
+    assert_capacity(request.kb_id)
+    logger.debug(f'question:{request.question}')
+    try:
+        parts = rag_service.__ask_stream__(request.session_id, request.question, request.kb_id)
+    except KnowledgeBaseUnloaded:
+        raise not_ready(request.kb_id)
+
+    async def events():
+        try:
+            async for state, text in parts:
+                yield server_sent_event(state, {'text': text})
+            yield server_sent_event('done', {})
+        except SchedulerBusy as busy:
+            yield server_sent_event('error', {'detail': str(busy), 'retry_after': busy.retry_after})
+        except Exception as ee:
+            logger.error(f'{repr(ee)}')
+            yield server_sent_event('error', {'detail': str(ee)})
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.get('/')
 async def get_root():
     return {'message': 'Hello UniChat!'}
 
 
+class ServiceStatus(BaseModel):
+    ready: bool
+    state: str  # idle, running, done or failed
+    progress: float
+    message: str
+
+
+@app.get('/healthz')
+async def check_health():
+    # The process is up and serving HTTP, whatever the state of the knowledge base is.
+    return {'status': 'ok'}
+
+
+@app.get('/readyz', response_model=ServiceStatus)
+async def check_readiness(kb_id: str | None = None):
+    # Only report. Probes are frequent, so they must not load knowledge bases and evict others.
+    try:
+        status = rag_service.service_status(kb_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Knowledge base {kb_id} does not exist.")
+    if not status['ready']:
+        raise not_ready(kb_id)
+    return status
+
+
+class KnowledgeBaseInfo(BaseModel):
+    kb_id: str
+    robot_desc: str
+    documents: List[str]
+    loaded: bool
+
+
+@app.get('/api/knowledge-bases', response_model=List[KnowledgeBaseInfo])
+async def list_knowledge_bases():
+    return rag_service.knowledge_bases()
+
+
+class AnswerCacheMetrics(BaseModel):
+    enabled: bool
+    entries: int
+    hits: int
+    misses: int
+    hit_rate: float
+
+
+class ProviderQueueMetrics(BaseModel):
+    concurrency: int
+    running: int
+    waiting: int
+    avg_seconds: float
+
+
+class SchedulerMetrics(BaseModel):
+    rejected: int
+    coalesced: int
+    providers: Dict[str, ProviderQueueMetrics]
+
+
+class SessionMetrics(BaseModel):
+    persistent: bool
+    sessions: int
+    bytes: int
+
+
+class ServiceMetrics(BaseModel):
+    answer_cache: AnswerCacheMetrics
+    scheduler: SchedulerMetrics
+    sessions: SessionMetrics
+
+
+@app.get('/api/metrics', response_model=ServiceMetrics)
+async def get_metrics():
+    return rag_service.metrics()
+
+
 class ModelSelect(BaseModel):
     llm_provider: str
     llm_model: str
@@ -279,19 +458,34 @@ async def query_config_suspense():
 
 class ChangesApply(BaseModel):
     status_ok: bool
+    job_id: str
 
 @app.post('/api/config-apply', response_model=ChangesApply)
 async def apply_changes_suspense():
     logger.info(f'POST: /api/config-apply')
     logger.info(f'Re-establishing the knowledge base...')
     try:
-        # Here you can add the logic to apply the configuration changes
-        # For example, restart the service
-        rag_service.restart_service()
-        return {'status_ok': True}
+        # The knowledge base is rebuilt in the background and swapped in once ready.
+        # Chatting goes on against the current one meanwhile.
+        job_id = rag_service.restart_service()
+        return {'status_ok': True, 'job_id': job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+class RebuildProgress(BaseModel):
+    job_id: str
+    state: str  # running, done or failed
+    progress: float
+    message: str
+
+@app.get('/api/config-apply/{job_id}', response_model=RebuildProgress)
+async def query_apply_progress(job_id: str):
+    logger.info(f'GET: /api/config-apply/{job_id}')
+    job = rag_service.rebuild_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} is unknown.")
+    return job
+
 @app.post('/api/file-format')
 async def convert_fformat(data_blob: UploadFile = File(...),
                           ext_name: str = Form(...), src_fmt: str = Form(...)):
@@ -375,7 +569,7 @@ def update_tray_menu(visible, q_action):
     else:
         q_action.setText('Show Console')
 
-ollsetting = OllamaSetting(logger, app_root)
+ollsetting = None
 
 # Function to create and show the system tray icon
 def create_system_tray(win_handler):
@@ -429,16 +623,24 @@ async def shutdown_event():
     try:
         # Necessary operations, like disconnecting database.
         logger.info("Clean up resources")
+        await rag_service.modconfig.http_pool.aclose()
     except asyncio.exceptions.CancelledError:
         logger.info("Async task cancelled during shutdown. Ignoring...")
 
 
+class UniServer(uvicorn.Server):
+    async def startup(self, sockets=None):
+        with phase_timer.phase('server bind'):
+            await super().startup(sockets=sockets)
+        phase_timer.report()
+
+
 # Function to start the uvicorn server
 def start_server():
     global server
     logger.info(f'Start the server...')
     # uvicorn.run(app, host="127.0.0.1", port=8000)
-    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=8000))
+    server = UniServer(uvicorn.Config(app, host="127.0.0.1", port=8000))
     server.run()
 
 
@@ -535,10 +737,6 @@ def console_ctrl_handler(ctrl_type):
         return True
     return True
 
-if os.name == 'nt':
-    # Register the console control handler
-    win32api.SetConsoleCtrlHandler(console_ctrl_handler, True)
-
 
 # from console_window import CustomConsole, CustomConsoleWriter
 from utils import running_in_pycharm, pycharm_hosted
@@ -548,6 +746,13 @@ if __name__ == "__main__":
                         help="Distribution mode specified. Development mode by default.")
     args = parser.parse_args()
 
+    init_service()
+    print(f'If the chat page is not opened within few seconds, please click the link {user_url} instead.')
+    ollsetting = OllamaSetting(logger, app_root)
+    if os.name == 'nt':
+        # Register the console control handler
+        win32api.SetConsoleCtrlHandler(console_ctrl_handler, True)
+
     max_retries = 5
     retry_delay = 1  # Delay 1 second
     addressed = False
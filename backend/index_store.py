@@ -0,0 +1,246 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+from typing import List, Dict, Union, Tuple, TYPE_CHECKING
+import numpy as np
+from vector_index import build_index
+from docstore import SqliteDocstore, StagingDocstore, PositionIdMap
+
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+
+
+class IndexStore():
+    """
+    Persist FAISS indexes and their docstores under <app_root>/index_cache so that an unchanged
+    knowledge base can be loaded from disk instead of being embedded again.
+
+    One index is kept per knowledge base and embedding setting (chunking parameters plus embedding
+    provider/model). Keys of knowledge bases other than the default one are prefixed with their ID. A manifest
+    next to it records the content digest and the chunk IDs of every document, which lets the caller update
+    the index incrementally when documents are added, changed or removed. The full-precision vectors are kept
+    as well, so that the searched index can be of any type and be rebuilt without embedding again.
+    """
+    cache_dir_name = "index_cache"
+    manifest_name = "manifest.json"
+    docstore_name = "docstore.sqlite"
+    meta_name = "index.json"
+    current_name = "CURRENT"  # Names the generation in use
+    vectors_name = "vectors.npy"  # Full-precision vectors, row i belonging to index position i
+    staging_suffix = ".staging"  # Scratch docstores of indexes being updated
+    max_entries = 4  # Keep a few recent indexes per knowledge base so that switching back is cheap as well.
+
+    def __init__(self, app_root, logger, docstore_cache_size: int = 1024):
+        self.logger = logger
+        self.root = os.path.join(app_root, self.cache_dir_name)
+        self.docstore_cache_size = docstore_cache_size
+
+    @staticmethod
+    def file_digest(file_path: str) -> str:
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def chunk_ids(file: str, texts: List[str], seen: Dict[bytes, int] | None = None) -> List[str]:
+        """
+        Derive stable chunk IDs from the document name and the chunk content. Repeated chunks within
+        one document are told apart by their occurrence count, so IDs never depend on chunk positions.
+        Pass the same `seen` dict for consecutive batches of chunks of one document. It counts chunks by
+        their digest, so it does not hold on to the text of the document.
+        """
+        seen = {} if seen is None else seen
+        ids = []
+        for text in texts:
+            data = text.encode('utf-8')
+            digest = hashlib.sha1(data).digest()
+            occurrence = seen.get(digest, 0)
+            seen[digest] = occurrence + 1
+            ids.append(hashlib.sha256(f'{file}\0{occurrence}\0'.encode('utf-8') + data).hexdigest()[:32])
+        return ids
+
+    def store_key(self, chunk_params: Dict[str, Union[int, str]], emb_provider: str, emb_model: str,
+                  kb_id: str | None = None) -> str:
+        payload = {
+            'chunking': chunk_params,
+            'embedding': [(emb_provider or '').upper(), emb_model or ''],
+        }
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return f'{kb_id}.{digest}' if kb_id else digest
+
+    def digest_documents(self, docs_dir: str, files: List[str]) -> Dict[str, str]:
+        digests = {}
+        for file in files:
+            file_path = os.path.join(docs_dir, file.strip())
+            if os.path.isfile(file_path):
+                digests[file.strip()] = self.file_digest(file_path)
+        return digests
+
+    def _entry_dir(self, key: str) -> str | None:
+        """
+        Return the directory of the current generation of an index. Every save writes a new generation,
+        because the files of the one in service are memory-mapped and cannot be replaced on Windows.
+        """
+        try:
+            with open(os.path.join(self.root, key, self.current_name), 'r', encoding='utf-8') as f:
+                return os.path.join(self.root, key, f.read().strip())
+        except OSError:
+            return None
+
+    def _remove_stale_generations(self, key_dir: str, current: str):
+        for d in os.listdir(key_dir):
+            if d != current and d != self.current_name:
+                # Generations still mapped by some process stay until a later save or prune.
+                shutil.rmtree(os.path.join(key_dir, d), ignore_errors=True)
+
+    def load_manifest(self, key: str) -> Tuple[Dict[str, Dict], Dict]:
+        """
+        Return the manifest of a persisted index, i.e. {file: {'digest': str, 'ids': [str]}}, and its
+        metadata, i.e. {'factory': index_factory string, 'ntotal': int, 'dim': int}.
+        """
+        entry_dir = self._entry_dir(key)
+        if entry_dir is None:
+            return {}, {}
+        try:
+            with open(os.path.join(entry_dir, self.manifest_name), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            with open(os.path.join(entry_dir, self.meta_name), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        return manifest, meta
+
+    def load(self, key: str, embeddings, writable: bool = False) -> 'FAISS | None':
+        """
+        Load the persisted index as served to searches. Its codes, i.e. the vectors of a flat index, are
+        memory-mapped read-only, so that processes serving the same index share one copy in the page cache
+        and start without reading the vectors.
+        Chunks stay on disk and are fetched when searches return them.
+        A writable one is flat and holds the full-precision vectors in memory instead, and its chunks in a
+        scratch docstore, so that chunks can be added and deleted.
+        """
+        import faiss
+        from langchain_community.vectorstores import FAISS
+        entry_dir = self._entry_dir(key)
+        if entry_dir is None or not os.path.isfile(os.path.join(entry_dir, 'index.faiss')):
+            return None
+        try:
+            if writable:
+                index = faiss.read_index(os.path.join(entry_dir, 'index.faiss'))
+                if not isinstance(index, faiss.IndexFlat):
+                    vectors = np.load(os.path.join(entry_dir, self.vectors_name))
+                    index = faiss.IndexFlatL2(vectors.shape[1])
+                    index.add(vectors)
+            else:
+                # IO_FLAG_MMAP only maps the inverted lists of IVF indexes. IO_FLAG_MMAP_IFC maps the codes
+                # of flat, SQ and HNSW indexes as well. Older faiss builds only know the former.
+                index = faiss.read_index(os.path.join(entry_dir, 'index.faiss'),
+                                         getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+                                         | faiss.IO_FLAG_READ_ONLY)
+            docstore = SqliteDocstore(os.path.join(entry_dir, self.docstore_name), self.docstore_cache_size)
+            if writable:
+                index_to_id = dict(enumerate(PositionIdMap(docstore).values()))
+                docstore.close()
+                db = FAISS(embeddings, index,
+                           self._staging_docstore(key, os.path.join(entry_dir, self.docstore_name)), index_to_id)
+            else:
+                db = FAISS(embeddings, index, docstore, PositionIdMap(docstore))
+        except Exception as e:
+            self.logger.warning(f'Failed to load the persisted index {entry_dir}: {repr(e)}. It shall be rebuilt.')
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            return None
+        os.utime(os.path.join(self.root, key))  # Mark as recently used
+        self.logger.info(f'Loaded the persisted index {key[:12]} with {db.index.ntotal} vectors.')
+        return db
+
+    def create(self, key: str, embeddings, dim: int) -> 'FAISS':
+        """
+        Create an empty writable index, to be filled and then persisted by save.
+        """
+        import faiss
+        from langchain_community.vectorstores import FAISS
+        return FAISS(embeddings, faiss.IndexFlatL2(dim), self._staging_docstore(key), {})
+
+    def _staging_docstore(self, key: str, source: str | None = None) -> StagingDocstore:
+        os.makedirs(self.root, exist_ok=True)
+        # Left behind by a crash. Those still open on Windows are removed by a later update.
+        for name in os.listdir(self.root):
+            if name.startswith(key + '.') and name.endswith(self.staging_suffix):
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+        return StagingDocstore(os.path.join(self.root, f'{key}.{time.time_ns():x}{self.staging_suffix}'), source)
+
+    def save(self, key: str, db: 'FAISS', manifest: Dict[str, Dict], spec: str, params: Dict[str, Union[int, str]]):
+        """
+        Persist a flat index along with the index of type `spec` built from its vectors for searching.
+        """
+        import faiss
+        key_dir = os.path.join(self.root, key)
+        if os.path.isdir(key_dir) and not os.path.isfile(os.path.join(key_dir, self.current_name)):
+            shutil.rmtree(key_dir, ignore_errors=True)  # Written before generations were introduced
+        generation = f'{time.time_ns():x}'
+        entry_dir = os.path.join(key_dir, generation)
+        temp_dir = entry_dir + '.tmp'
+        os.makedirs(temp_dir)
+        vectors = db.index.reconstruct_n(0, db.index.ntotal)
+        np.save(os.path.join(temp_dir, self.vectors_name), vectors)
+        index = db.index if spec == 'Flat' else build_index(vectors, spec, params, self.logger)
+        faiss.write_index(index, os.path.join(temp_dir, 'index.faiss'))
+        SqliteDocstore.write(os.path.join(temp_dir, self.docstore_name),
+                             (db.docstore.search(db.index_to_docstore_id[pos]) for pos in range(db.index.ntotal)))
+        with open(os.path.join(temp_dir, self.manifest_name), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        with open(os.path.join(temp_dir, self.meta_name), 'w', encoding='utf-8') as f:
+            json.dump({'factory': spec, 'ntotal': int(db.index.ntotal), 'dim': int(db.index.d)}, f)
+        # Switch to the complete generation at once so that a crash never leaves a half-written index behind.
+        os.replace(temp_dir, entry_dir)
+        with open(os.path.join(key_dir, self.current_name + '.tmp'), 'w', encoding='utf-8') as f:
+            f.write(generation)
+        os.replace(os.path.join(key_dir, self.current_name + '.tmp'), os.path.join(key_dir, self.current_name))
+        self._remove_stale_generations(key_dir, generation)
+        # The serialized index is about what the vectors take in memory once loaded. The docstore stays on disk.
+        ntotal = max(1, db.index.ntotal)
+        index_bytes = os.path.getsize(os.path.join(entry_dir, 'index.faiss'))
+        docstore_bytes = os.path.getsize(os.path.join(entry_dir, self.docstore_name))
+        self.logger.info(f'Persisted the {spec} index {key[:12]} with {db.index.ntotal} vectors. Memory: '
+                         f'vectors {index_bytes / 2**20:.1f} MB ({index_bytes / ntotal:.0f} bytes per chunk). '
+                         f'Disk: docstore {docstore_bytes / 2**20:.1f} MB ({docstore_bytes / ntotal:.0f} bytes per chunk).')
+        self.prune()
+
+    def vectors(self, key: str) -> np.ndarray:
+        """
+        Memory-map the full-precision vectors of a persisted index read-only.
+        """
+        return np.load(os.path.join(self._entry_dir(key), self.vectors_name), mmap_mode='r')
+
+    def footprint(self, key: str) -> int:
+        """
+        Estimate the bytes a loaded index takes in memory: its vectors plus the keyword index built from
+        its chunks, which grows with the docstore.
+        """
+        entry_dir = self._entry_dir(key)
+        if entry_dir is None:
+            return 0
+        return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in ('index.faiss', self.docstore_name)
+                   if os.path.isfile(os.path.join(entry_dir, name)))
+
+    def prune(self):
+        groups: Dict[str, List[str]] = {}
+        for d in os.listdir(self.root):
+            if os.path.isdir(os.path.join(self.root, d)):
+                groups.setdefault(d.rpartition('.')[0], []).append(os.path.join(self.root, d))
+        for entries in groups.values():
+            entries.sort(key=os.path.getmtime, reverse=True)
+            for key_dir in entries[:self.max_entries]:
+                entry_dir = self._entry_dir(os.path.basename(key_dir))
+                if entry_dir:
+                    self._remove_stale_generations(key_dir, os.path.basename(entry_dir))
+            for key_dir in entries[self.max_entries:]:
+                shutil.rmtree(key_dir, ignore_errors=True)
+                self.logger.info(f'Removed the stale index {key_dir}')
@@ -0,0 +1,56 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingIngestor():
+    """
+    Embed chunks in batches of a configurable size, keeping at most `concurrency` batches in flight
+    through the sync embedding API of the provider. The async clients of the provider are left to the
+    server loop, as they can not be shared with another event loop. Throughput and ETA are reported to
+    the log. One ingestor may be fed several times while documents are streamed in; the figures then
+    cover the whole run.
+    """
+    report_interval = 2.0  # seconds
+
+    def __init__(self, embeddings: Embeddings, logger, batch_size: int = 32, concurrency: int = 2):
+        self.embeddings = embeddings
+        self.logger = logger
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.started = None
+        self.reported = None
+        self.done = 0
+        self.elapsed = 0.0  # Wall time spent waiting for embeddings
+
+    def embed(self, texts: List[str], progress: float | None = None) -> List[List[float]]:
+        """
+        Embed the texts. `progress` is the fraction of the whole run the texts complete, if known,
+        which the ETA is then estimated from. Otherwise the ETA only covers the given texts.
+        """
+        if len(texts) == 0:
+            return []
+        start = time.perf_counter()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results: List[List[List[float]]] = [[] for _ in batches]
+        if self.started is None:
+            self.started = self.reported = start
+        target = self.done + len(texts)
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                futures = {executor.submit(self.embeddings.embed_documents, b): i for i, b in enumerate(batches)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    results[i] = future.result()
+                    self.done += len(batches[i])
+                    now = time.perf_counter()
+                    if now - self.reported >= self.report_interval or self.done == target:
+                        self.reported = now
+                        elapsed = max(now - self.started, 1e-6)
+                        rate = self.done / elapsed
+                        eta = elapsed * (1 / progress - 1) if progress else (target - self.done) / rate
+                        self.logger.info(f'Embedded {self.done} chunks, {rate:.1f} chunks/s, ETA {eta:.0f}s')
+        finally:
+            self.elapsed += time.perf_counter() - start
+        return [vector for batch in results for vector in batch]
@@ -0,0 +1,63 @@
+import time
+import threading
+from typing import List, Dict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+    from conversation import RagPipeline
+
+
+class KnowledgeBaseUnloaded(Exception):
+    """
+    Raised when a knowledge base found ready was unloaded before its chain was taken.
+    """
+
+    def __init__(self, kb_id: str):
+        super().__init__(f'Knowledge base {kb_id} is not loaded.')
+        self.kb_id = kb_id
+
+
+class KnowledgeBase():
+    """
+    One knowledge base, i.e. its documents and robot description, along with the index and the conversation
+    chain serving it once loaded. The default knowledge base is the one configured in [Knowledge]; it is built
+    at startup and always kept. The others are loaded on first use and may be unloaded again to save memory.
+    """
+    default_id = 'default'
+
+    def __init__(self, kb_id: str, docs_dir: str, files: List[str], robot_desc: str):
+        self.kb_id = kb_id
+        self.docs_dir = docs_dir
+        self.files = files
+        self.robot_desc = robot_desc
+        self.db: 'FAISS | None' = None
+        self.index_key: str | None = None
+        self.manifest: Dict[str, Dict] = {}
+        self.chain: 'RagPipeline | None' = None
+        self.footprint = 0  # Estimated bytes held in memory once loaded
+        self.last_used = 0.0
+        self.failed = False  # The latest load failed. It is retried after the configuration is reloaded.
+        # FAISS indexes are safe for concurrent searches, but not for a search running while vectors are added.
+        self.db_lock = threading.RLock()
+
+    @property
+    def is_default(self) -> bool:
+        return self.kb_id == self.default_id
+
+    @property
+    def ready(self) -> bool:
+        return self.chain is not None
+
+    def pipeline(self) -> 'RagPipeline':
+        # Taken once per request, as the chain may be unloaded by another thread at any time.
+        chain = self.chain
+        if chain is None:
+            raise KnowledgeBaseUnloaded(self.kb_id)
+        return chain
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def unload(self):
+        # Requests in flight keep what they hold. The index and the docstore are freed after them.
+        self.db, self.chain, self.footprint = None, None, 0
@@ -0,0 +1,69 @@
+import re
+import math
+import heapq
+from collections import Counter
+from typing import List, Dict, Tuple
+
+# Latin words, numbers and codes such as "HX-200" or "v1.2" are kept whole. CJK runs are cut into
+# overlapping character bigrams, which needs no dictionary and matches terms of any length.
+_WORD = re.compile(r'[0-9a-z]+(?:[-_.][0-9a-z]+)*')
+_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_TOKEN = re.compile(f'{_WORD.pattern}|{_CJK.pattern}')
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for m in _TOKEN.finditer(text.lower()):
+        run = m.group(0)
+        if _CJK.fullmatch(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+            if '-' in run or '_' in run or '.' in run:
+                # Let "HX-200" be found by "hx200" and by its parts as well.
+                parts = re.split(r'[-_.]', run)
+                tokens.append(''.join(parts))
+                tokens.extend(parts)
+    return tokens
+
+
+class BM25Index():
+    """
+    In-memory inverted index scoring chunks with Okapi BM25. It is built from the chunks already in
+    the vector store, so lexical matching costs no embedding round trip.
+    """
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, ids: List[str], texts: List[str]):
+        self.ids = ids
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}  # term: [(chunk index, term frequency)]
+        self.lengths = []
+        for i, text in enumerate(texts):
+            terms = Counter(tokenize(text))
+            self.lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append((i, tf))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """
+        Return up to k (chunk ID, score) pairs, best first. Chunks sharing no term with the query are left out.
+        """
+        n = len(self.ids)
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return [(self.ids[i], score) for i, score in heapq.nlargest(k, scores.items(), key=lambda s: s[1])]
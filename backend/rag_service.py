@@ -1,36 +1,48 @@
 import os, sys, re
-import shutil
-from typing import List, Dict, Union, Tuple
-from pydantic import BaseModel
-# from langchain_community.embeddings import OpenAIEmbeddings
-from langchain.chains import RetrievalQA
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_ollama import OllamaEmbeddings, ChatOllama
-from langchain_community.llms.moonshot import Moonshot
-# from langchain_community.llms.baichuan import BaichuanLLM
-from langchain_community.chat_models import ChatZhipuAI, ChatBaichuan, ChatTongyi
-from langchain_deepseek import ChatDeepSeek
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import BaichuanTextEmbeddings, ZhipuAIEmbeddings
+import time
+import json
+import hashlib
+import uuid
+import threading
+import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Dict, Union, Tuple, Iterator, AsyncIterator, Callable, TYPE_CHECKING
+# Provider integrations, FAISS and document loaders are imported where they are needed,
+# since a deployment only ever uses one LLM provider and one embedding provider.
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.document_loaders import TextLoader, PyMuPDFLoader
-from langchain_community.document_loaders.markdown import UnstructuredMarkdownLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
-from langchain_community.document_loaders.word_document import Docx2txtLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
-from langchain_text_splitters.markdown import MarkdownTextSplitter
-
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.output_parsers import StrOutputParser
+
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from pypandoc import convert_file as cvt_doctype
 from uni_config import UniConfig
+from index_store import IndexStore
+from vector_index import index_spec, tune_index, is_lossy, RefinedIndex
+from emb_cache import EmbeddingCache, CachedEmbeddings
+from ingestion import EmbeddingIngestor
+from retrievers import GuardedRetriever, HybridRetriever
+from lexical_index import BM25Index
+from docstore import iter_documents
+from answer_cache import SemanticAnswerCache
+from knowledge_base import KnowledgeBase
+from scheduler import RequestScheduler
+from http_pool import HttpClientPool
+from session_store import SessionStore
+from token_budget import PromptPacker, prepare_encoding
+from conversation import RagPipeline, ThinkSplitter
+from doc_loader import DOC_TYPES, pdf_page_count, csv_parts, split_document
+from utils import PhaseTimer
+
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
 
 
 class ModelConfig():
+    pdf_pages_per_task = 32
+    csv_rows_per_task = 2000
+    parallel_min_bytes = 1 << 20  # Small jobs are parsed in place since worker start-up costs more.
+
     def __init__(self, app_root, logger, cfg: UniConfig):
         # self.super().__init__()
         self.logger = logger
@@ -41,25 +53,50 @@ class ModelConfig():
         self.files: list = cfg.get_documents()  #dcfg['Knowledge']['DOCUMENTS']  # os.getenv("DOCUMENTS")
         self.robot_desc: str = cfg.get_robot_desc()  #dcfg['Knowledge']['ROBOT_DESC']  # os.getenv("ROBOT_DESC")
         self.logger = logger
+        self.http_pool = HttpClientPool(logger, **cfg.get_http_config())
+        # Model clients by (kind, provider, model), reused by rebuilds which keep the setting.
+        self._models: Dict[Tuple[str, str, str], Any] = {}
 
     def local_docs_dir(self):
         return self.LOCAL_DOCS_DIR
 
+    def reload_documents(self):
+        self.files = self.cfg.get_documents()
+        self.robot_desc = self.cfg.get_robot_desc()
+
+    def chunk_params(self) -> Dict[str, Tuple[int, int]]:
+        # Chunk size and overlap per file type, e.g. {'.pdf': (300, 20)}
+        return {ext: self.cfg.get_chunk_params(ext.lstrip('.')) for ext in DOC_TYPES}
+
     def instantiate_llm(self, llm_provider: str, llm_model: str):
+        key = ('llm', llm_provider.upper(), llm_model)
+        if key in self._models:
+            return self._models[key]
         if llm_provider.upper() == 'OPENAI':
-            llm = ChatOpenAI(model=llm_model, temperature=0.3)
+            from langchain_openai import ChatOpenAI
+            http_client, http_async_client = self.http_pool.clients(llm_provider)
+            llm = ChatOpenAI(model=llm_model, temperature=0.3,
+                             http_client=http_client, http_async_client=http_async_client)
         elif llm_provider.upper() == 'MOONSHOT':
+            from langchain_community.llms.moonshot import Moonshot
             llm = Moonshot(model=llm_model)
         elif llm_provider.upper() == 'BAICHUAN':
+            from langchain_community.chat_models import ChatBaichuan
             llm = ChatBaichuan(model=llm_model, temperature=0.3)
         elif llm_provider.upper() == 'ZHIPUAI':
+            from langchain_community.chat_models import ChatZhipuAI
             llm = ChatZhipuAI(model=llm_model, temperature=0.3)
         elif llm_provider.upper() == 'DEEPSEEK':
-            llm = ChatDeepSeek(model=llm_model, temperature=0.3)
+            from langchain_deepseek import ChatDeepSeek
+            http_client, http_async_client = self.http_pool.clients(llm_provider)
+            llm = ChatDeepSeek(model=llm_model, temperature=0.3,
+                               http_client=http_client, http_async_client=http_async_client)
         elif llm_provider.upper() == 'DASHSCOPE':
+            from langchain_community.chat_models import ChatTongyi
             llm = ChatTongyi(model=llm_model, top_p=0.3)
         elif llm_provider.upper() == 'OLLAMA':
-            llm = ChatOllama(model=llm_model, temperature=0.3)
+            from langchain_ollama import ChatOllama
+            llm = ChatOllama(model=llm_model, temperature=0.3, client_kwargs=self.http_pool.client_kwargs())
         else:
             # raise RuntimeWarning(f'LLM provider {llm_provider} is not supported yet.')
             self.logger.error(f'LLM provider {llm_provider} is not supported. '
@@ -68,20 +105,30 @@ class ModelConfig():
             self.logger.warning(f'Please close and restart the app to take new LLM config effective...')
             while True:
                 pass
+        self._models[key] = llm
         return llm
 
     def instantiate_emb(self, emb_provider: str, emb_model: str):
+        key = ('emb', emb_provider.upper(), emb_model)
+        if key in self._models:
+            return self._models[key]
         if emb_provider.upper() == 'OPENAI':
-            embeddings = OpenAIEmbeddings(model=emb_model)  # "text-embedding-ada-002"
+            from langchain_openai import OpenAIEmbeddings
+            http_client, http_async_client = self.http_pool.clients(emb_provider)
+            embeddings = OpenAIEmbeddings(model=emb_model,  # "text-embedding-ada-002"
+                                          http_client=http_client, http_async_client=http_async_client)
         elif emb_provider.upper() == 'BAICHUAN':
+            from langchain_community.embeddings import BaichuanTextEmbeddings
             embeddings = BaichuanTextEmbeddings(model=emb_model) if emb_model else BaichuanTextEmbeddings()
         elif emb_provider.upper() == 'ZHIPUAI':
+            from langchain_community.embeddings import ZhipuAIEmbeddings
             embeddings = ZhipuAIEmbeddings()  # 'glm-3-turbo'
         elif emb_provider.upper().startswith('OLLAMA'):  # This branch is handled specially.
             self.logger.info(f'NOTE: You have chosen Ollama as embedding framework. '
                              f'Please run up Ollama locally beforehand.')
             assert emb_model, f'One model must be specified in case of Ollama for embedding.'
-            embeddings = OllamaEmbeddings(model=emb_model)
+            from langchain_ollama import OllamaEmbeddings
+            embeddings = OllamaEmbeddings(model=emb_model, client_kwargs=self.http_pool.client_kwargs())
         else:
             # raise RuntimeWarning(f'Embedding provider {emb_provider} is not supported. Please check your setting.')
             self.logger.error(f'Embedding provider {emb_provider} is not supported. '
@@ -90,88 +137,68 @@ class ModelConfig():
             self.logger.warning(f'Please close and restart the app to take new embedding config effective...')
             while True:
                 pass
+        self._models[key] = embeddings
         return embeddings
 
     def read_documents(self)->list:
         pages = []
-        for file in self.files:
-            file_path = os.path.join(self.LOCAL_DOCS_DIR, file.strip())
+        for _, chunks, _ in self.iter_documents(self.files):
+            pages.extend(chunks)
+        return pages
+
+    def iter_documents(self, files: List[str], docs_dir: str | None = None)->Iterator[Tuple[str, list, float]]:
+        """
+        Parse and split documents part by part, i.e. a whole document or a page range of a large PDF or
+        a row batch of a large CSV. Yield (document, chunks, fraction of parts done) in document order.
+        Parts are parsed in a process pool if there is enough work to pay for it, with a bounded number
+        of them in flight, so memory does not grow with the size of the corpus.
+        """
+        tasks = []
+        for file in files:
+            file_path = os.path.join(docs_dir or self.LOCAL_DOCS_DIR, file.strip())
             if not os.path.exists(file_path):
                 self.logger.warn(f'{file_path} does not exist and be ignored.')
                 continue
             bn, ext = os.path.splitext(file_path)
             assert len(ext.strip()) > 0, f'Extension name is missing from {file_path}'
-            if ext.lower() == '.md':
-                # Considering of loading markdown needing NLTK data. It makes it complicated.
-                # Here a workaround is that markdown files are firstly converted to Word and
-                # then loaded as Word documents.
-                if os.path.exists('temp'):
-                    shutil.rmtree('temp')
-                os.makedirs('temp')
-                temp_file = os.path.join('temp', os.path.split(file_path)[1])
-                temp_file = os.path.splitext(temp_file)[0] + '.docx'
-                cvt_doctype(file_path, 'docx', outputfile=temp_file)
-                ext = '.docx'
-                file_path = temp_file
-
-            if ext.lower() == '.txt':
-                # Load .txt document
-                self.logger.info(f'Load text document {file_path} ...')
-                loader = TextLoader(file_path, encoding='utf-8', autodetect_encoding=True)
-                documents = loader.load()
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=20)
-                pages.extend(text_splitter.split_documents(documents))
-                assert len(pages) > 0, f'No content is loaded yet. Please check document {file_path}'
-            elif ext.lower() == '.md':
-                # Load .MD document
-                self.logger.info(f'Load markdown document {file_path} ...')
-                try:
-                    loader = UnstructuredMarkdownLoader(file_path, mode='elements',
-                                                        autodetect_coding=True, strategy="fast", )
-                except Exception as e:
-                    raise RuntimeError(f'Loading {file_path} failed. {repr(e)}')
-                documents = loader.load()
-                text_splitter = MarkdownTextSplitter.from_language(language=Language("markdown"),
-                                                                   chunk_size=300, chunk_overlap=20)
-                pages.extend(text_splitter.split_documents(documents))
-                assert len(pages) > 0, f'No content is loaded yet. Please check document {file_path}'
-            elif ext.lower() == '.pdf':
-                # Load .PDF document
-                self.logger.info(f'Load PDF document {file_path} ...')
-                loader = PyMuPDFLoader(file_path)
-                documents = loader.load()
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=20)
-                doc_pages = text_splitter.split_documents(documents)
-                pages.extend(doc_pages)
-                assert len(pages) > 0, f'No content is loaded yet. Please check document {file_path}'
-            elif ext.lower() == '.docx':
-                # Load Word document
-                self.logger.info(f'Load Word document {file_path} ...')
-                loader = Docx2txtLoader(file_path=file_path)
-                documents = loader.load()
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=20)
-                doc_pages = text_splitter.split_documents(documents)
-                pages.extend(doc_pages)
-                assert len(pages) > 0, f'No content is loaded yet. Please check document {file_path}'
+            if ext.lower() not in DOC_TYPES:
+                raise RuntimeWarning(f'File type {ext} is not supported yet.')
+            self.logger.info(f'Load {DOC_TYPES[ext.lower()]} document {file_path} ...')
+            if ext.lower() == '.pdf':
+                num_pages = pdf_page_count(file_path)
+                parts = [(start, min(start + self.pdf_pages_per_task, num_pages))
+                         for start in range(0, num_pages, self.pdf_pages_per_task)]
             elif ext.lower() == '.csv':
-                # Load CSV document
-                self.logger.info(f'Load CSV document {file_path} ...')
-                loader = CSVLoader(file_path=file_path, encoding='utf-8')
-                documents = loader.load()
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=20)
-                doc_pages = text_splitter.split_documents(documents)
-                pages.extend(doc_pages)
-                assert len(pages) > 0, f'No content is loaded yet. Please check document {file_path}'
+                parts = csv_parts(file_path, self.csv_rows_per_task)
             else:
-                raise RuntimeWarning(f'File type {ext} is not supported yet.')
-
-        return pages
+                parts = []
+            tasks.extend([(file, file_path, part) for part in parts] if len(parts) > 1 else [(file, file_path, None)])
+
+        chunk_params = self.chunk_params()
+        task_args = [(t[1], *chunk_params[os.path.splitext(t[1])[1].lower()], t[2]) for t in tasks]
+        total_bytes = sum(os.path.getsize(path) for path in set(t[1] for t in tasks))
+        if len(tasks) > 1 and total_bytes >= self.parallel_min_bytes:
+            num_workers = min(len(tasks), os.cpu_count() or 1)
+            self.logger.info(f'Parse {len(tasks)} document part(s) with {num_workers} worker process(es).')
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                pending = deque()
+                for i, (task, args) in enumerate(zip(tasks, task_args)):
+                    pending.append((task[0], executor.submit(split_document, *args)))
+                    if len(pending) >= 2 * num_workers:
+                        file, future = pending.popleft()
+                        yield file, future.result(), (i + 1 - len(pending)) / len(tasks)
+                while pending:
+                    file, future = pending.popleft()
+                    yield file, future.result(), (len(tasks) - len(pending)) / len(tasks)
+        else:
+            for i, (task, args) in enumerate(zip(tasks, task_args)):
+                yield task[0], split_document(*args), (i + 1) / len(tasks)
 
 class RagService():
-    # Maintain history
-    store = {}  # Keep all chat history. key:session_id,value:chat message
     memory_key = "history"
-    hb_size_limit = 128
+    kb_dir_name = "knowledge_bases"  # Documents of knowledge bases other than the default one
+    index_batch_size = 512  # Chunks per embed and add round while ingesting
+    max_jobs_kept = 16
 
     context_q_system_prompt = (
         "Given a chat history and the latest user question which might reference context in the chat history, "
@@ -181,74 +208,321 @@ class RagService():
 
     def __init__(self, app_root, logger):
         # self.super().__init__()
-        self._local_docs_dir = None
         self.app_root = app_root
         self.logger = logger
         self.cfg = UniConfig(app_root, logger)
         self.modconfig = ModelConfig(app_root, logger, self.cfg)
-        self._conversation_chain = None
+        self.index_store = IndexStore(app_root, logger, self.cfg.get_docstore_cache_size())
+        self.emb_cache = EmbeddingCache(self.index_store.root, logger, self.cfg.get_emb_cache_limit())
+        self._swap_lock = threading.Lock()
+        self._jobs: Dict[str, Dict] = {}
+        self._kbs: OrderedDict[str, KnowledgeBase] = OrderedDict()  # Least recently used first
+        self._refresh_knowledge_bases()
+        # Keep chat history. key:session_id,value:chat messages
+        session_config = self.cfg.get_session_config()
+        self.store = SessionStore(logger, session_config['max_messages'], session_config['ttl'],
+                                  session_config['max_mb'],
+                                  os.path.join(self.index_store.root, SessionStore.file_name)
+                                  if session_config['persistent'] else None)
+        self.answer_cache = SemanticAnswerCache(logger, **self.cfg.get_answer_cache_config())
+        self.scheduler = RequestScheduler(logger, self.cfg.get_llm_concurrency, self.cfg.get_max_queue())
 
     @property
     def msg_chain(self):
-        return self._conversation_chain
+        return self._kbs[KnowledgeBase.default_id].chain
+
+    def _refresh_knowledge_bases(self):
+        """
+        Take the knowledge bases from the configuration. Loaded ones other than the default are unloaded,
+        so that they are loaded again with the current configuration on next use.
+        """
+        configured = self.cfg.get_knowledge_bases()
+        with self._swap_lock:
+            for kb_id in [k for k in self._kbs if k not in configured]:
+                del self._kbs[kb_id]
+            for kb_id, kb_cfg in configured.items():
+                docs_dir = (os.path.abspath(os.path.join(self.app_root, kb_cfg['docs_dir'])) if kb_cfg['docs_dir']
+                            else os.path.join(self.app_root, self.kb_dir_name, kb_id))
+                if kb_id == KnowledgeBase.default_id:
+                    docs_dir = self.modconfig.local_docs_dir()
+                kb = self._kbs.get(kb_id)
+                if kb is None:
+                    kb = self._kbs[kb_id] = KnowledgeBase(kb_id, docs_dir, kb_cfg['documents'], kb_cfg['robot_desc'])
+                else:
+                    kb.docs_dir, kb.files, kb.robot_desc = docs_dir, kb_cfg['documents'], kb_cfg['robot_desc']
+                    kb.failed = False
+                    if not kb.is_default and kb.ready:
+                        kb.unload()
+                        self.logger.info(f'Unloaded knowledge base {kb_id} to reload it with the new configuration.')
+
+    def knowledge_base(self, kb_id: str | None = None) -> KnowledgeBase:
+        """
+        Return the knowledge base of the ID, the default one if None. Raise KeyError for an unknown ID.
+        """
+        return self._kbs[kb_id or KnowledgeBase.default_id]
+
+    def knowledge_bases(self) -> List[Dict]:
+        return [{'kb_id': kb.kb_id, 'robot_desc': kb.robot_desc, 'documents': kb.files, 'loaded': kb.ready}
+                for kb in self._kbs.values()]
+
+    def ensure_loaded(self, kb_id: str | None = None) -> bool:
+        """
+        Return whether the knowledge base is ready to answer. One not loaded yet is loaded in the background,
+        unless its last load failed. The default knowledge base is built by start_service.
+        """
+        kb = self.knowledge_base(kb_id)
+        kb.touch()
+        with self._swap_lock:
+            if kb.kb_id in self._kbs:
+                self._kbs.move_to_end(kb.kb_id)
+        if kb.ready:
+            return True
+        if not kb.is_default and not kb.failed:
+            self._start_job(reset=False, kb=kb)
+        return False
+
+    def _evict(self):
+        # Unload the least recently used knowledge bases other than the default beyond the memory limit.
+        limit = self.cfg.get_kb_cache_limit() * 1024 * 1024
+        with self._swap_lock:
+            loaded = [kb for kb in self._kbs.values() if kb.ready and not kb.is_default]
+            total = sum(kb.footprint for kb in loaded)
+            running = {j['kb_id'] for j in self._jobs.values() if j['state'] == 'running'}
+            for kb in loaded[:-1]:  # The one loaded last stays, however large it is.
+                if total <= limit:
+                    break
+                if kb.kb_id in running:
+                    continue
+                total -= kb.footprint
+                kb.unload()
+                self.logger.info(f'Unloaded knowledge base {kb.kb_id} to keep knowledge bases within the memory limit.')
 
     def remove_useless(self, doc_list: list):
         # Get the latest document list
         latest_documents = [doc.strip() for doc in doc_list]
 
         # Get the list of all files in the local_docs folder
-        all_files = os.listdir(self._local_docs_dir)
+        all_files = os.listdir(self.modconfig.local_docs_dir())
 
         # Identify the files that are not in the latest document list
         useless_files = [f for f in all_files if f not in latest_documents]
 
         # Remove the useless files
         for f in useless_files:
-            file_path = os.path.join(self._local_docs_dir, f)
+            file_path = os.path.join(self.modconfig.local_docs_dir(), f)
             if os.path.isfile(file_path):
                 os.remove(file_path)
                 self.logger.info(f"Removed the useless: {file_path}")
 
-    def _embed_documents(self):
-        pages = self.modconfig.read_documents()
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=300,
-            chunk_overlap=20,
-            length_function=len,
-            add_start_index=True,
-        )
-        texts = text_splitter.create_documents(
-            [page.page_content for page in pages]
-        )
-        for j, t in enumerate(texts):
-            t.id = f'Doc-{j}'
-
-        embeddings = self.modconfig.instantiate_emb(*self.cfg.retrieve_embconfig())
-
-        # Choose vector DB and fill the DB
-        db = FAISS.from_documents(texts, embeddings)
+    def _embed_documents(self, kb: KnowledgeBase, on_first_batch: Callable[['FAISS'], None] | None = None,
+                         on_progress: Callable[[float], None] | None = None,
+                         timer: PhaseTimer | None = None) -> Tuple['FAISS', str, Dict[str, Dict]]:
+        """
+        Bring the index of the current embedding setting up to date with the knowledge base. Documents
+        are streamed through parse -> split -> embed -> add to index in bounded batches; `on_first_batch`
+        is called as soon as the index holds its first vectors.
+
+        The index in service is never modified. The update works on the persisted copy, so that the
+        caller can swap the result in once it is complete.
+        """
+        started = time.perf_counter()
+        emb_provider, emb_model = self.cfg.retrieve_embconfig()
+        embeddings = CachedEmbeddings(self.modconfig.instantiate_emb(emb_provider, emb_model),
+                                      self.emb_cache, emb_provider, emb_model)
+
+        # One index is maintained per knowledge base and embedding setting.
+        index_key = self.index_store.store_key(self.modconfig.chunk_params(), emb_provider, emb_model,
+                                               None if kb.is_default else kb.kb_id)
+        index_params = self.cfg.get_index_config()
+        manifest, meta = self.index_store.load_manifest(index_key)
+
+        # Work out which documents need to be (re-)embedded and which vectors are stale.
+        digests = self.index_store.digest_documents(kb.docs_dir, kb.files)
+        removed = [f for f in manifest if f not in digests]
+        changed = [f for f, d in digests.items() if manifest.get(f, {}).get('digest') != d]
+        if (manifest and not (removed or changed)
+                and meta.get('factory') == index_spec(index_params, meta['ntotal'], meta['dim'])):
+            db = self.index_store.load(index_key, embeddings)
+            if db is not None:
+                self._prepare_index(db, index_key, meta['factory'], index_params)
+                if timer:
+                    timer.add('ingest', time.perf_counter() - started)
+                return db, index_key, manifest
+
+        # Updates go to a flat copy. The index type in service is built from it afterwards.
+        db = self.index_store.load(index_key, embeddings, writable=True) if manifest else None
+        if db is None:
+            manifest, removed, changed = {}, [], list(digests)
+        self.logger.info(f'Update the knowledge base: {len(changed)} new or changed document(s) '
+                         f'and {len(removed)} removed document(s).')
+        deleted = 0
+        stale_ids = [chunk_id for f in removed for chunk_id in manifest.pop(f)['ids']]
+        if db is not None and stale_ids:
+            with kb.db_lock:
+                db.delete(stale_ids)
+            deleted += len(stale_ids)
+        ingestor = EmbeddingIngestor(embeddings, self.logger, *self.cfg.get_ingestion_config(emb_provider))
+        old_ids = {f: set(manifest.get(f, {}).get('ids', [])) for f in changed}
+        new_ids = {f: [] for f in changed}
+        batch = []
+
+        def flush(progress: float):
+            nonlocal db
+            vectors = ingestor.embed([t.page_content for t in batch], progress)
+            text_embeddings = list(zip([t.page_content for t in batch], vectors))
+            metadatas = [t.metadata for t in batch]
+            # Choose vector DB and fill the DB
+            # Chunks go to the scratch docstore of the index right away instead of being held in memory.
+            with kb.db_lock:
+                if db is None:
+                    db = self.index_store.create(index_key, embeddings, len(vectors[0]))
+                db.add_embeddings(text_embeddings, metadatas=metadatas, ids=[t.id for t in batch])
+            if on_first_batch and db.index.ntotal == len(batch):
+                on_first_batch(db)
+            batch.clear()
+
+        progress = 0.0
+        current, seen = None, {}
+        for f, texts, progress in self.modconfig.iter_documents(changed, kb.docs_dir):
+            # Parts of a document come in a row. Its chunk occurrences are forgotten once it is done.
+            if f != current:
+                current, seen = f, {}
+            for t, chunk_id in zip(texts, self.index_store.chunk_ids(f, [t.page_content for t in texts], seen)):
+                t.id = chunk_id
+                t.metadata['source'] = f  # Relative to the knowledge base folder
+                new_ids[f].append(chunk_id)
+                if chunk_id not in old_ids[f]:
+                    batch.append(t)
+            if len(batch) >= self.index_batch_size:
+                flush(progress)
+            if on_progress:
+                on_progress(progress)
+        if batch:
+            flush(progress)
+
+        # Vectors of edited chunks are dropped only after their replacements are in.
+        stale_ids = [chunk_id for f in changed for chunk_id in old_ids[f].difference(new_ids[f])]
+        if stale_ids:
+            with kb.db_lock:
+                db.delete(stale_ids)
+            deleted += len(stale_ids)
+        for f in changed:
+            manifest[f] = {'digest': digests[f], 'ids': new_ids[f]}
+        self.logger.info(f'Embedded {ingestor.done} and deleted {deleted} chunk(s).')
+        self.logger.info(f'Embedding cache: {embeddings.hits} hit(s), {embeddings.misses} miss(es).')
+        ingested = time.perf_counter()
+        spec = index_spec(index_params, db.index.ntotal, db.index.d)
+        self.index_store.save(index_key, db, manifest, spec, index_params)
+        db = self.index_store.load(index_key, embeddings)
+        self._prepare_index(db, index_key, spec, index_params)
+        if timer:
+            # Parsing, splitting and indexing vs. waiting for the embedding provider
+            timer.add('ingest', ingested - started - ingestor.elapsed)
+            timer.add('embed', ingestor.elapsed)
+            timer.add('index build', time.perf_counter() - ingested)
+        return db, index_key, manifest
+
+    def _prepare_index(self, db: 'FAISS', index_key: str, spec: str, index_params: Dict):
+        tune_index(db.index, index_params)
+        if is_lossy(spec) and index_params['rerank']:
+            db.index = RefinedIndex(db.index, self.index_store.vectors(index_key), index_params['rerank_factor'])
+
+    def _retriever(self, db: 'FAISS', kb: KnowledgeBase) -> HybridRetriever:
+        params = self.cfg.get_retrieval_config()
         # Get retriever and extract top results
-        retriever = db.as_retriever(search_type="mmr", search_kwargs={"k": 3})
-
-        return retriever
-
-    def get_session_history(self, session_id) -> BaseChatMessageHistory:  # A key/session_id pair for a question/answer pair
-        if session_id not in self.store:
-            self.logger.info(f'Create session \"{session_id}\"')
-            self.store[session_id] = ChatMessageHistory()
-        return self.store[session_id]
-
-    def setup_service(self, local_docs_dir, reset: bool = False):
-        if reset:
-            self.cfg.reload_config()
-            self.store.clear()
-        else:
-            self._local_docs_dir = local_docs_dir
-
-        retriever = self._embed_documents()
-
-        llm = self.modconfig.instantiate_llm(*self.cfg.retrieve_llmconfig())
-
+        vector_retriever = GuardedRetriever(
+            retriever=db.as_retriever(search_type="mmr", search_kwargs={"k": params['candidates']}),
+            lock=kb.db_lock)
+        # The keyword index is rebuilt from the chunks in the vector store. This takes no embedding at all.
+        ids, texts = [], []
+        with kb.db_lock:
+            for chunk in iter_documents(db.docstore, db.index_to_docstore_id):
+                ids.append(chunk.id)
+                texts.append(chunk.page_content)
+        lexical_index = BM25Index(ids, texts)
+        self.logger.info(f'Built the keyword index over {len(lexical_index)} chunks.')
+        return HybridRetriever(vector_retriever=vector_retriever, lexical_index=lexical_index,
+                               docstore=db.docstore, lock=kb.db_lock, **params)
+
+    @staticmethod
+    def _session_key(session_id: str, kb: KnowledgeBase | None = None) -> str:
+        # A session asking several knowledge bases keeps a history with each. The separator is escaped in
+        # both IDs, so that no session ID of the default knowledge base reads as that of another one.
+        def escape(text: str) -> str:
+            return text.replace('\\', '\\\\').replace(':', '\\:')
+        if kb is None or kb.is_default:
+            return escape(session_id)
+        return f'{escape(kb.kb_id)}:{escape(session_id)}'
+
+    def get_session_history(self, session_id, kb: KnowledgeBase | None = None) -> BaseChatMessageHistory:  # A key/session_id pair for a question/answer pair
+        return self.store.get(self._session_key(session_id, kb))
+
+    def setup_service(self, local_docs_dir, reset: bool = False,
+                      on_progress: Callable[[float], None] | None = None, timer: PhaseTimer | None = None,
+                      kb: KnowledgeBase | None = None):
+        """
+        Build the knowledge base, the default one if None, and its conversation chain.
+        Pass a timer to have the phases recorded.
+        """
+        timer = timer or PhaseTimer(self.logger)
+        kb = kb or self.knowledge_base()
+        with timer.phase('config'):
+            if reset:
+                self.cfg.reload_config()
+                self.modconfig.reload_documents()
+                self._refresh_knowledge_bases()
+            # Before the documents are parsed, as their chunks are counted in tokens.
+            prepare_encoding(self.index_store.root)
+
+            llm_provider, llm_model = self.cfg.retrieve_llmconfig()
+            llm = self.modconfig.instantiate_llm(llm_provider, llm_model)
+            condenser_provider, condenser_model = self.cfg.retrieve_condenser_config()
+            condenser_llm = (self.modconfig.instantiate_llm(condenser_provider, condenser_model)
+                             if condenser_provider else llm)
+            models = ((llm_provider, llm_model),
+                      (condenser_provider, condenser_model) if condenser_provider else (llm_provider, llm_model))
+
+        def serve_early(db: 'FAISS'):
+            # Serve the first vectors while the rest of the knowledge base is still being ingested.
+            # Answers of a partial knowledge base are not cached.
+            if kb.chain is None:
+                kb.chain = self._build_chain(llm, condenser_llm, self._retriever(db, kb), db.embeddings, None,
+                                             models, kb.robot_desc)
+
+        db, index_key, manifest = self._embed_documents(kb, on_first_batch=serve_early, on_progress=on_progress,
+                                                        timer=timer)
+        version = self._version(kb, index_key, manifest, (condenser_provider, condenser_model))
+        with timer.phase('chain build'):
+            conversation_chain = self._build_chain(llm, condenser_llm, self._retriever(db, kb), db.embeddings,
+                                                  version, models, kb.robot_desc)
+
+        # Hot swap. Requests in flight finish on the chain they started with.
+        with self._swap_lock:
+            previous = kb.chain.version if kb.chain else None
+            kb.db, kb.index_key, kb.manifest = db, index_key, manifest
+            kb.chain = conversation_chain
+            kb.footprint = self.index_store.footprint(index_key)
+        if previous and previous != version:
+            self.answer_cache.discard(previous)
+        self._evict()
+
+    def _version(self, kb: KnowledgeBase, index_key: str, manifest: Dict[str, Dict], condenser: Tuple) -> str:
+        """
+        Identify what answers depend on: the documents and how they are indexed, the model and the prompt.
+        """
+        payload = {
+            'index': index_key,
+            'documents': {f: m['digest'] for f, m in manifest.items()},
+            'llm': self.cfg.retrieve_llmconfig(verbose=False),
+            'condenser': condenser,
+            'robot_desc': kb.robot_desc,
+            'retrieval': self.cfg.get_retrieval_config(),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _build_chain(self, llm, condenser_llm, retriever: HybridRetriever, embeddings,
+                     version: str | None, models: Tuple[Tuple[str, str], Tuple[str, str]],
+                     robot_desc: str) -> RagPipeline:
         # Step 1: Contextualize the query based on chat history
         contextualize_query_prompt = ChatPromptTemplate.from_messages(
             [
@@ -258,16 +532,12 @@ class RagService():
             ]
         )
 
-        # Step 2: Build a history-aware retriever to replace classic retriever in following steps.
-        history_aware_retriever = create_history_aware_retriever(
-            llm,
-            retriever,
-            contextualize_query_prompt
-        )
+        # Step 2: Condense a follow-up question into a standalone one for retrieval.
+        condense_chain = contextualize_query_prompt | condenser_llm | StrOutputParser()
 
         # Step 3: Build system prompt
         deployment = self.cfg.get_deployment_profile()
-        system_prompt = (f"""{self.cfg.get_robot_desc()}。
+        system_prompt = (f"""{robot_desc}。
                        你的任务是根据下述给定的已知信息回答用户问题。
                        确保你的回复完全依据下述已知信息，不要编造答案。
                        请用中文回答用户问题。
@@ -286,58 +556,209 @@ class RagService():
         # Step 5: Set up a sub-chain for question-answer purpose. LLM | Prompt
         question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
 
-        # Step 6: Construct the chain based on RAG+History for multi-loop question-answer.
-        rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-        # Step 7: Construct runnable object of RAG+History chain.
-        conversation_rag_chain = RunnableWithMessageHistory(
-            rag_chain,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key=self.memory_key,
-            output_messages_key="answer",
-        )
-
-        self._conversation_chain = conversation_rag_chain
+        # Step 6: Run condense -> retrieve -> answer step by step, keeping the chat history in RagService.
+        # LLM calls are scheduled per provider, i.e. that of the LLM and that of the condenser.
+        # Prompts are packed into the token budget of either model.
+        (llm_provider, llm_model), (condenser_provider, condenser_model) = models
+        answer_packer = PromptPacker(self.logger, *self.cfg.get_token_budget(llm_provider, llm_model), system_prompt)
+        condense_packer = PromptPacker(self.logger, *self.cfg.get_token_budget(condenser_provider, condenser_model),
+                                       self.context_q_system_prompt)
+        return RagPipeline(condense_chain, retriever, question_answer_chain, embeddings, version,
+                           bypass=self.cfg.get_condenser_bypass(), scheduler=self.scheduler,
+                           llm_provider=llm_provider, condenser_provider=condenser_provider,
+                           answer_packer=answer_packer, condense_packer=condense_packer)
 
     def _split_ai_answer(self, ai_message: str)->Tuple[str, str]:
-        ai_thinks = []
-        m_thinks = re.findall(r'<think>([\s\S]*)</think>', ai_message)
-        if len(m_thinks) > 0:
-            [ai_thinks.append(th.strip()) for th in m_thinks if len(th.strip()) > 0]
-            if len(ai_thinks) > 0:
-                # reasoning = ('<<<<<< 推理开始 >>>>>>\n\n' + '\n------\n'.join(ai_thinks)
-                #              + '\n\n<<<<<< 推理完成 >>>>>>\n\n')
-                ai_reasoning = '\n'.join(ai_thinks)
-            else:
-                ai_reasoning = ''
-        else:
-            ai_reasoning = ''
-        if len(ai_reasoning) > 0:
-            m_summary = re.match(r'[\s\S]*</think>([\s\S]*)', ai_message)
-            if m_summary:
-                ai_summary = m_summary.group(1).strip()
-            else:
-                ai_summary = ''
+        return ThinkSplitter.split(ai_message)
+
+    async def _lookup(self, pipeline: RagPipeline, question: str, history: List):
+        standalone_question = await pipeline.acondense(question, history)
+        cached, query_vector = None, None
+        if self.answer_cache.enabled and pipeline.version:
+            query_vector = await pipeline.embeddings.aembed_query(standalone_question)
+            cached = self.answer_cache.lookup(pipeline.version, query_vector)
+        return standalone_question, query_vector, cached
+
+    async def _retrieve_context(self, pipeline: RagPipeline, standalone_question: str,
+                                query_vector: List[float] | None = None) -> List:
+        context = await pipeline.aretrieve(standalone_question, query_vector)
+        self.logger.debug('Retrieved: ' + ', '.join(
+            f"{d.metadata.get('source')}(page={d.metadata.get('page')}, row={d.metadata.get('row')}, "
+            f"offset={d.metadata.get('start_index')})" for d in context))
+        return context
+
+    @staticmethod
+    def _coalesce_key(pipeline: RagPipeline, question: str, history: List) -> Tuple[str, str, str] | None:
+        # The answer prompt includes the chat history even for questions which need no condensing. So only
+        # identical questions with identical histories, mostly none, against the same knowledge base and
+        # model may share a generation.
+        if pipeline.version and pipeline.is_standalone(question, history):
+            digest = hashlib.sha256(json.dumps([(m.type, str(m.content)) for m in history],
+                                               ensure_ascii=False).encode('utf-8')).hexdigest()
+            return pipeline.version, question.strip(), digest
+        return None
+
+    def _remember(self, session_history: BaseChatMessageHistory, question: str, ai_answering: str):
+        # Add the summary answer to the chat history only, i.e. exclude reasoning.
+        # The history keeps a bounded number of messages, dropping the earliest ones.
+        session_history.add_messages([HumanMessage(content=question), AIMessage(content=ai_answering)])
+
+    def check_capacity(self, kb_id: str | None = None):
+        """
+        Raise scheduler.SchedulerBusy if the LLM is too busy to take another question.
+        """
+        # All knowledge bases answer with the configured LLM. Their chains may be unloaded at any time.
+        self.knowledge_base(kb_id)
+        llm_provider, _ = self.cfg.retrieve_llmconfig(verbose=False)
+        self.scheduler.check(llm_provider)
+
+    async def __ask__(self, session_id: str, question: str, kb_id: str | None = None)->Tuple[str,str]:
+        """
+        Answer on the event loop. LLM and embedding calls go through the async clients of the providers,
+        and index searches run in worker threads, so that concurrent sessions overlap their waits.
+        """
+        kb = self.knowledge_base(kb_id)
+        pipeline = kb.pipeline()
+        session_history = self.get_session_history(session_id, kb)
+        history = list(session_history.messages)
+        key = self._coalesce_key(pipeline, question, history)
+        shared = self.scheduler.join(key) if key else None
+        if shared is not None:
+            self.logger.info(f'Share the answer being generated to "{question}".')
+            ai_answering, ai_reasoning = await asyncio.shield(shared)
         else:
-            ai_summary = ai_message.strip()
-        return ai_summary, ai_reasoning
-
-    def __ask__(self, session_id: str, question: str)->Tuple[str,str]:
-        output = self._conversation_chain.invoke(
-            {'input': question},
-            config={'configurable': {'session_id': session_id}}
-        )
-        ai_answering, ai_reasoning = self._split_ai_answer(output['answer'])
-        # Add the summary answer to the chat history only
-        session_history = self.get_session_history(session_id)
-        if session_history.messages[-1].type == 'ai':
-            session_history.messages[-1].content = ai_answering  # Exclude reasoning
-        num_excess = len(session_history.messages) - self.hb_size_limit
-        if num_excess > 0:
-            self.logger.info(f'Discard the earliest {num_excess} messages as history buffer size imit.')
-            [session_history.messages.pop(0) for _ in range(num_excess)]
+            async with self.scheduler.lead(key) as shared:
+                standalone_question, query_vector, cached = await self._lookup(pipeline, question, history)
+                if cached:
+                    ai_answering, ai_reasoning = cached
+                else:
+                    context = await self._retrieve_context(pipeline, standalone_question, query_vector)
+                    ai_answering, ai_reasoning = self._split_ai_answer(
+                        await pipeline.aanswer(question, history, context))
+                    if query_vector is not None:
+                        self.answer_cache.put(pipeline.version, query_vector, standalone_question,
+                                              ai_answering, ai_reasoning)
+                shared.set_result((ai_answering, ai_reasoning))
+        self._remember(session_history, question, ai_answering)
         return ai_answering, ai_reasoning
 
-    def restart_service(self):
-        self.setup_service(self._local_docs_dir, reset=True)
+    def __ask_stream__(self, session_id: str, question: str,
+                       kb_id: str | None = None) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Answer as __ask__ does, but yield (ThinkSplitter.REASONING or ThinkSplitter.ANSWER, text) parts
+        as the LLM generates them. The chat history is updated once the answer is complete.
+        Requests sharing the generation of another get the complete parts at its end.
+        The chain is taken right away, so that an unloaded knowledge base is reported before streaming starts.
+        """
+        kb = self.knowledge_base(kb_id)
+        return self._stream_answer(kb, kb.pipeline(), session_id, question)
+
+    async def _stream_answer(self, kb: KnowledgeBase, pipeline: RagPipeline, session_id: str,
+                             question: str) -> AsyncIterator[Tuple[str, str]]:
+        session_history = self.get_session_history(session_id, kb)
+        history = list(session_history.messages)
+        key = self._coalesce_key(pipeline, question, history)
+        shared = self.scheduler.join(key) if key else None
+        if shared is not None:
+            self.logger.info(f'Share the answer being generated to "{question}".')
+            ai_answering, ai_reasoning = await asyncio.shield(shared)
+            if ai_reasoning:
+                yield ThinkSplitter.REASONING, ai_reasoning
+            yield ThinkSplitter.ANSWER, ai_answering
+        else:
+            async with self.scheduler.lead(key) as shared:
+                standalone_question, query_vector, cached = await self._lookup(pipeline, question, history)
+                if cached:
+                    ai_answering, ai_reasoning = cached
+                    if ai_reasoning:
+                        yield ThinkSplitter.REASONING, ai_reasoning
+                    yield ThinkSplitter.ANSWER, ai_answering
+                else:
+                    context = await self._retrieve_context(pipeline, standalone_question, query_vector)
+                    splitter = ThinkSplitter()
+                    parts = {ThinkSplitter.REASONING: [], ThinkSplitter.ANSWER: []}
+                    async for chunk in pipeline.astream_answer(question, history, context):
+                        for state, text in splitter.feed(chunk):
+                            parts[state].append(text)
+                            yield state, text
+                    for state, text in splitter.finish():
+                        parts[state].append(text)
+                        yield state, text
+                    ai_answering = ''.join(parts[ThinkSplitter.ANSWER]).strip()
+                    ai_reasoning = ''.join(parts[ThinkSplitter.REASONING]).strip()
+                    if query_vector is not None:
+                        self.answer_cache.put(pipeline.version, query_vector, standalone_question,
+                                              ai_answering, ai_reasoning)
+                shared.set_result((ai_answering, ai_reasoning))
+        self._remember(session_history, question, ai_answering)
+
+    def metrics(self) -> Dict[str, Dict]:
+        return {'answer_cache': self.answer_cache.stats(), 'scheduler': self.scheduler.stats(),
+                'sessions': self.store.stats()}
+
+    @property
+    def ready(self) -> bool:
+        return self.knowledge_base().ready
+
+    def service_status(self, kb_id: str | None = None) -> Dict:
+        """
+        Readiness of a knowledge base, the default one if None, along with the state of its latest build job, if any.
+        """
+        kb = self.knowledge_base(kb_id)
+        status = {'ready': kb.ready, 'state': 'idle', 'progress': 1.0, 'message': ''}
+        job = next((j for j in reversed(self._jobs.values()) if j['kb_id'] == kb.kb_id), None)
+        if job:
+            status.update(state=job['state'], progress=job['progress'], message=job['message'])
+        return status
+
+    def start_service(self, local_docs_dir) -> str:
+        """
+        Build the knowledge base and the chain in the background, so that the caller can serve requests
+        right away. Return the ID of the build job.
+        """
+        return self._start_job(reset=False)
+
+    def restart_service(self) -> str:
+        """
+        Rebuild the knowledge base and the chain in the background and swap them in once ready.
+        The current ones keep serving meanwhile. Return the ID of the rebuild job.
+        """
+        return self._start_job(reset=True)
+
+    def _start_job(self, reset: bool, kb: KnowledgeBase | None = None) -> str:
+        kb = kb or self.knowledge_base()
+        with self._swap_lock:
+            # A reset reloads the configuration, so it waits for no other job than one of its own kind.
+            running = [j for j in self._jobs.values() if j['state'] == 'running' and j['kb_id'] == kb.kb_id]
+            if running:
+                self.logger.info(f'Rebuild {running[0]["job_id"]} is in progress already.')
+                return running[0]['job_id']
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {'job_id': job_id, 'kb_id': kb.kb_id, 'state': 'running', 'progress': 0.0,
+                                  'message': '', 'started': time.time(), 'finished': None}
+            for stale in [j for j in self._jobs if self._jobs[j]['state'] != 'running'][:-self.max_jobs_kept]:
+                del self._jobs[stale]
+        threading.Thread(target=self._rebuild, args=(self._jobs[job_id], reset, kb), name=f'rebuild-{job_id[:8]}',
+                         daemon=True).start()
+        return job_id
+
+    def _rebuild(self, job: Dict, reset: bool = True, kb: KnowledgeBase | None = None):
+        kb = kb or self.knowledge_base()
+        self.logger.info(f'Rebuild {job["job_id"]} of knowledge base {kb.kb_id} started.')
+        timer = PhaseTimer(self.logger)
+        try:
+            self.setup_service(kb.docs_dir, reset=reset,
+                               on_progress=lambda p: job.update(progress=round(p, 3)), timer=timer, kb=kb)
+            timer.report(f'Rebuild {job["job_id"]}')
+            job.update(state='done', progress=1.0)
+            self.logger.info(f'Rebuild {job["job_id"]} completed and swapped in.')
+        except Exception as e:
+            kb.failed = True
+            job.update(state='failed', message=repr(e))
+            self.logger.error(f'Rebuild {job["job_id"]} failed: {repr(e)}. The previous knowledge base stays in service.')
+        finally:
+            job['finished'] = time.time()
+
+    def rebuild_status(self, job_id: str) -> Dict | None:
+        job = self._jobs.get(job_id)
+        return dict(job) if job else None
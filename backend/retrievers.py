@@ -0,0 +1,124 @@
+import asyncio
+from typing import List, Dict, Any
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStoreRetriever
+
+
+class GuardedRetriever(BaseRetriever):
+    """
+    Serialize searches with writes to the underlying index. FAISS indexes are safe for concurrent
+    searches, but not for a search running while vectors are being added.
+
+    Searches return chunk IDs, as FAISS' MMR search does on vectors alone. The chunks are fetched from the
+    docstore by the caller, only for the IDs it keeps.
+    """
+    retriever: VectorStoreRetriever
+    lock: Any  # threading.RLock
+
+    def search_ids(self, embedding: List[float]) -> List[str]:
+        vectorstore, search_kwargs = self.retriever.vectorstore, self.retriever.search_kwargs
+        k = search_kwargs.get('k', 4)
+        mmr = self.retriever.search_type == 'mmr'
+        vector = np.array([embedding], dtype=np.float32)
+        with self.lock:
+            _, indices = vectorstore.index.search(vector, search_kwargs.get('fetch_k', 20) if mmr else k)
+            positions = [int(i) for i in indices[0] if i != -1]  # -1 when the index holds fewer vectors
+            if mmr and positions:
+                from langchain_community.vectorstores.utils import maximal_marginal_relevance
+                selected = maximal_marginal_relevance(vector, [vectorstore.index.reconstruct(p) for p in positions],
+                                                      k=k, lambda_mult=search_kwargs.get('lambda_mult', 0.5))
+                positions = [positions[i] for i in selected]
+            return [vectorstore.index_to_docstore_id[p] for p in positions]
+
+    async def asearch_ids(self, embedding: List[float]) -> List[str]:
+        # The search runs under the lock, in a worker thread.
+        return await asyncio.to_thread(self.search_ids, embedding)
+
+    def _get_documents(self, ids: List[str]) -> List[Document]:
+        docstore = self.retriever.vectorstore.docstore
+        with self.lock:
+            return [doc for doc in map(docstore.search, ids) if isinstance(doc, Document)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self._get_documents(self.search_ids(self.retriever.vectorstore.embeddings.embed_query(query)))
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        # The query is embedded through the async client without holding the lock.
+        embedding = await self.retriever.vectorstore.embeddings.aembed_query(query)
+        return await asyncio.to_thread(self._get_documents, await self.asearch_ids(embedding))
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuse vector search with BM25 keyword search through weighted reciprocal rank fusion, i.e. a chunk
+    scores weight / (rrf_k + rank) for each list it appears in. Keyword search catches exact terms
+    such as product names and codes which embeddings tend to blur.
+    """
+    vector_retriever: GuardedRetriever
+    lexical_index: Any  # lexical_index.BM25Index
+    docstore: Any  # Chunk ID -> Document, i.e. the docstore of the vector store
+    lock: Any  # threading.RLock
+    k: int = 3
+    candidates: int = 20  # Hits taken from either search before fusion
+    vector_weight: float = 1.0
+    lexical_weight: float = 1.0
+    rrf_k: int = 60
+
+    def _fuse(self, vector_ids: List[str], lexical_hits: List) -> List[Document]:
+        scores: Dict[str, float] = {}
+        for rank, chunk_id in enumerate(vector_ids, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + self.vector_weight / (self.rrf_k + rank)
+        for rank, (chunk_id, _) in enumerate(lexical_hits, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + self.lexical_weight / (self.rrf_k + rank)
+        # Only the chunks making the cut are fetched from the docstore.
+        results = []
+        with self.lock:
+            for chunk_id in sorted(scores, key=scores.get, reverse=True):
+                doc = self.docstore.search(chunk_id)
+                if isinstance(doc, Document):  # The chunk may have been deleted meanwhile.
+                    results.append(doc)
+                if len(results) == self.k:
+                    break
+        return results
+
+    def _lexical_search(self, query: str) -> List:
+        return self.lexical_index.search(query, self.candidates) if self.lexical_weight > 0 else []
+
+    @property
+    def embeddings(self):
+        return self.vector_retriever.retriever.vectorstore.embeddings
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_ids = (self.vector_retriever.search_ids(self.embeddings.embed_query(query))
+                      if self.vector_weight > 0 else [])
+        return self._fuse(vector_ids, self._lexical_search(query))
+
+    async def aget_by_vector(self, query: str, embedding: List[float] | None) -> List[Document]:
+        """
+        Search with the vector of the query if it was embedded already, e.g. for the answer cache, instead
+        of embedding it again.
+        """
+        # Keyword search runs in a worker thread while the query is being embedded and searched.
+        lexical = asyncio.create_task(asyncio.to_thread(self._lexical_search, query))
+        try:
+            vector_ids = []
+            if self.vector_weight > 0:
+                if embedding is None:
+                    embedding = await self.embeddings.aembed_query(query)
+                vector_ids = await self.vector_retriever.asearch_ids(embedding)
+            lexical_hits = await lexical
+        finally:
+            # Left unawaited if the vector search failed or the request was cancelled.
+            if not lexical.done():
+                lexical.cancel()
+            elif not lexical.cancelled():
+                lexical.exception()  # Marks a failure as retrieved, which the other one is reported for.
+        return await asyncio.to_thread(self._fuse, vector_ids, lexical_hits)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await self.aget_by_vector(query, None)
@@ -0,0 +1,126 @@
+import math
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Callable, Hashable, Union
+
+
+class SchedulerBusy(Exception):
+    """
+    Raised when the queue of a provider is full. `position` is where the request would have queued and
+    `retry_after` the estimated seconds until a place frees up.
+    """
+
+    def __init__(self, provider: str, position: int, retry_after: int):
+        super().__init__(f'{position - 1} requests are queued for {provider} already.')
+        self.provider = provider
+        self.position = position
+        self.retry_after = retry_after
+
+
+class _ProviderQueue():
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.running = 0
+        self.avg_duration = 0.0  # Exponential moving average of the seconds a request holds a slot
+
+
+class RequestScheduler():
+    """
+    Admission control in front of the LLMs. At most `concurrency(provider)` questions are answered at a time
+    per provider, e.g. no more than a local Ollama serves in parallel, and up to `max_queue` more wait for a
+    slot. Beyond that SchedulerBusy is raised rather than piling requests up.
+
+    Identical questions in flight at the same time share one generation, see `join` and `lead`.
+    """
+
+    def __init__(self, logger, concurrency: Callable[[str], int], max_queue: int = 32):
+        self.logger = logger
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._queues: Dict[str, _ProviderQueue] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.rejected = 0
+        self.coalesced = 0
+
+    def _queue(self, provider: str) -> _ProviderQueue:
+        provider = (provider or '').upper()
+        if provider not in self._queues:
+            concurrency = max(1, self.concurrency(provider))
+            self.logger.info(f'Answer at most {concurrency} question(s) at a time with {provider}.')
+            self._queues[provider] = _ProviderQueue(concurrency)
+        return self._queues[provider]
+
+    def _retry_after(self, queue: _ProviderQueue) -> int:
+        # The whole queue has to drain through the slots before a place is sure to be free.
+        return max(1, math.ceil((queue.avg_duration or 5.0) * (queue.waiting + 1) / queue.concurrency))
+
+    def check(self, provider: str):
+        """
+        Raise SchedulerBusy if a request for the provider would be turned away now.
+        """
+        queue = self._queue(provider)
+        if queue.semaphore.locked() and queue.waiting >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerBusy(provider, queue.waiting + 1, self._retry_after(queue))
+
+    @asynccontextmanager
+    async def slot(self, provider: str):
+        queue = self._queue(provider)
+        self.check(provider)
+        if queue.semaphore.locked():
+            self.logger.debug(f'Queued for {provider} at position {queue.waiting + 1}.')
+        queue.waiting += 1
+        try:
+            await queue.semaphore.acquire()
+        finally:
+            queue.waiting -= 1
+        queue.running += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            queue.running -= 1
+            queue.semaphore.release()
+            duration = time.perf_counter() - started
+            queue.avg_duration = duration if not queue.avg_duration else 0.8 * queue.avg_duration + 0.2 * duration
+
+    def join(self, key: Hashable) -> asyncio.Future | None:
+        """
+        Return the future of the identical request in flight, if any. Await it through asyncio.shield, so that
+        a follower giving up does not cancel the generation for the others.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    @asynccontextmanager
+    async def lead(self, key: Hashable | None):
+        """
+        Register a request others may join while it runs, unless the key is None. The caller sets the result
+        on the future yielded. Should the request fail or be given up without a result, the followers get an error.
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting for it, so mark an exception as retrieved.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if key is not None:
+            self._inflight[key] = future
+        try:
+            yield future
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            if key is not None and self._inflight.get(key) is future:
+                del self._inflight[key]
+            if not future.done():
+                future.set_exception(RuntimeError('The shared request was abandoned.'))
+
+    def stats(self) -> Dict[str, Union[int, Dict[str, Dict[str, Union[int, float]]]]]:
+        return {'rejected': self.rejected, 'coalesced': self.coalesced,
+                'providers': {p: {'concurrency': q.concurrency, 'running': q.running, 'waiting': q.waiting,
+                                  'avg_seconds': round(q.avg_duration, 3)} for p, q in self._queues.items()}}
@@ -0,0 +1,189 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import deque, OrderedDict
+from typing import List, Sequence, Tuple, Dict, Union
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+_ROLES = {'human': HumanMessage, 'ai': AIMessage}
+
+
+def _size(content: str) -> int:
+    return len(content.encode('utf-8'))
+
+
+class SessionHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session, kept as a deque of (role, content) pairs. The oldest messages fall off
+    once `max_messages` is reached. Messages are added through the SessionStore owning the history.
+    """
+
+    def __init__(self, store: 'SessionStore', session_id: str, max_messages: int,
+                 turns: Sequence[Tuple[str, str]] = ()):
+        self.store = store
+        self.session_id = session_id
+        self.turns: deque[Tuple[str, str]] = deque(turns, maxlen=max_messages)
+        self.size = sum(_size(content) for _, content in self.turns)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return [_ROLES[role](content=content) for role, content in self.turns]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.append(self, [(m.type, str(m.content)) for m in messages if m.type in _ROLES])
+
+    def clear(self) -> None:
+        self.store.clear(self)
+
+
+class SessionStore():
+    """
+    Chat histories by session ID. Sessions idle for longer than `ttl` seconds are dropped, and the least
+    recently used ones are let go from memory once the messages held exceed `max_mb` in total.
+
+    With `db_path`, histories are written through to SQLite, so that they survive restarts and sessions let go
+    from memory are read back when they return. Otherwise, a session let go from memory is lost.
+    """
+    file_name = "sessions.sqlite"
+    expire_interval = 60  # seconds between sweeps for idle sessions
+
+    def __init__(self, logger, max_messages: int = 128, ttl: int = 86400, max_mb: int = 64,
+                 db_path: str | None = None):
+        self.logger = logger
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_bytes = max_mb * 1024 * 1024
+        self._sessions: OrderedDict[str, SessionHistory] = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._size = 0
+        self._lock = threading.RLock()
+        self._last_expire = time.time()
+        self._conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                               'session_id TEXT PRIMARY KEY, last_used REAL NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, '
+                               'session_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_session ON messages(session_id, id)')
+            self._conn.commit()
+            self._expire(time.time())
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            if session_id in self._sessions:
+                return True
+            return bool(self._conn and self._conn.execute('SELECT 1 FROM sessions WHERE session_id=?',
+                                                          (session_id,)).fetchone())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> SessionHistory:
+        now = time.time()
+        with self._lock:
+            if now - self._last_expire > self.expire_interval:
+                self._expire(now)
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = self._load(session_id)
+                self._sessions[session_id] = history
+                self._size += history.size
+            self._sessions.move_to_end(session_id)
+            self._last_used[session_id] = now
+            self._evict()
+            return history
+
+    def _load(self, session_id: str) -> SessionHistory:
+        turns = []
+        if self._conn:
+            turns = self._conn.execute('SELECT role, content FROM messages WHERE session_id=? ORDER BY id DESC '
+                                       'LIMIT ?', (session_id, self.max_messages)).fetchall()[::-1]
+        if turns:
+            self.logger.debug(f'Restore session "{session_id}" with {len(turns)} messages.')
+        else:
+            self.logger.info(f'Create session "{session_id}"')
+        return SessionHistory(self, session_id, self.max_messages, turns)
+
+    def append(self, history: SessionHistory, turns: List[Tuple[str, str]]):
+        now = time.time()
+        with self._lock:
+            current = self._sessions.get(history.session_id)
+            if current is None:
+                # Let go from memory while the answer was generated. It is the latest session again.
+                current = self._sessions[history.session_id] = history
+                self._size += history.size
+            # Otherwise the turns go to the history in use, should the session have been loaded again meanwhile.
+            self._sessions.move_to_end(history.session_id)
+            for turn in turns:
+                if len(current.turns) == current.turns.maxlen:
+                    dropped = _size(current.turns[0][1])
+                    current.size -= dropped
+                    self._size -= dropped
+                current.turns.append(turn)
+                current.size += _size(turn[1])
+                self._size += _size(turn[1])
+            self._last_used[history.session_id] = now
+            if self._conn:
+                self._conn.executemany('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                                       [(history.session_id, role, content) for role, content in turns])
+                # Keep as many messages on disk as in memory.
+                self._conn.execute('DELETE FROM messages WHERE session_id=? AND id NOT IN (SELECT id FROM messages '
+                                   'WHERE session_id=? ORDER BY id DESC LIMIT ?)',
+                                   (history.session_id, history.session_id, self.max_messages))
+                self._conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?)', (history.session_id, now))
+                self._conn.commit()
+            self._evict()
+
+    def clear(self, history: SessionHistory):
+        with self._lock:
+            if self._sessions.get(history.session_id) is history:
+                self._size -= history.size
+            history.turns.clear()
+            history.size = 0
+            if self._conn:
+                self._conn.execute('DELETE FROM messages WHERE session_id=?', (history.session_id,))
+                self._conn.commit()
+
+    def _drop(self, session_id: str):
+        history = self._sessions.pop(session_id, None)
+        self._last_used.pop(session_id, None)
+        if history is not None:
+            self._size -= history.size
+
+    def _evict(self):
+        # The session in use is the most recent one and stays, however large it is.
+        evicted = 0
+        while self._size > self.max_bytes and len(self._sessions) > 1:
+            self._drop(next(iter(self._sessions)))
+            evicted += 1
+        if evicted:
+            self.logger.info(f'Let go {evicted} session(s) from memory as the session memory limit.'
+                             + ('' if self._conn else ' Their history is lost.'))
+
+    def _expire(self, now: float):
+        self._last_expire = now
+        idle = [s for s, t in self._last_used.items() if now - t > self.ttl]
+        for session_id in idle:
+            self._drop(session_id)
+        if self._conn:
+            rows = self._conn.execute('SELECT session_id FROM sessions WHERE last_used<?', (now - self.ttl,)).fetchall()
+            self._conn.executemany('DELETE FROM messages WHERE session_id=?', rows)
+            self._conn.executemany('DELETE FROM sessions WHERE session_id=?', rows)
+            self._conn.commit()
+            idle = set(idle) | {r[0] for r in rows}
+        if idle:
+            self.logger.info(f'Discard {len(idle)} session(s) idle for over {self.ttl} seconds.')
+
+    def stats(self) -> Dict[str, Union[bool, int]]:
+        with self._lock:
+            return {'persistent': self._conn is not None, 'sessions': len(self._sessions), 'bytes': self._size}
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
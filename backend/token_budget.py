@@ -0,0 +1,135 @@
+import os
+import re
+import hashlib
+import logging
+from typing import List, Sequence, Tuple
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+
+# Tokens are counted with tiktoken's cl100k_base. Models with other tokenizers get an estimate, which is what
+# a budget needs. Should the encoding not be available, e.g. offline without tiktoken's cache, a character
+# based estimate is taken instead: a CJK character is about one token, other text about four characters one.
+# tiktoken downloads the encoding without a timeout, so it is fetched once by prepare_encoding and only ever
+# read from the cache afterwards, also by the worker processes parsing documents.
+
+_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+_MESSAGE_OVERHEAD = 4  # Role and separators of a chat message
+_CHUNK_OVERHEAD = 2  # Separator between chunks stuffed into the context
+_ENCODING_URL = 'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken'
+_encoding = None
+_download_failed = False  # Not retried by later rebuilds of the same process
+
+
+def _cache_path() -> str | None:
+    # Where tiktoken looks for the encoding, see tiktoken.load.read_file_cached
+    cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR')
+    return os.path.join(cache_dir, hashlib.sha1(_ENCODING_URL.encode()).hexdigest()) if cache_dir else None
+
+
+def prepare_encoding(cache_dir: str, timeout: float = 10):
+    """
+    Have the encoding cached in `cache_dir`, downloading it with a timeout if it is not yet. Processes started
+    afterwards inherit TIKTOKEN_CACHE_DIR. Tokens are estimated by characters as long as the download fails.
+    """
+    global _encoding, _download_failed
+    os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+    path = _cache_path()
+    if os.path.isfile(path) or _download_failed:
+        return
+    try:
+        import requests
+        response = requests.get(_ENCODING_URL, timeout=timeout)
+        response.raise_for_status()
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(response.content)
+        os.replace(path + '.tmp', path)
+        _encoding = None  # Count by tiktoken from now on.
+    except Exception as e:
+        _download_failed = True
+        logging.getLogger('shared_logger').warning(f'Failed to download the tiktoken encoding: {e!r}')
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            path = _cache_path()
+            if path is None or not os.path.isfile(path):
+                raise FileNotFoundError('The encoding is not cached.')
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            logging.getLogger('shared_logger').warning(f'Estimate tokens by characters as tiktoken is unavailable: {e!r}')
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_tokens(doc: Document) -> int:
+    # Chunks are counted once at ingest. Those of knowledge bases ingested before are counted here.
+    n_tokens = doc.metadata.get('n_tokens')
+    return (n_tokens if n_tokens is not None else count_tokens(doc.page_content)) + _CHUNK_OVERHEAD
+
+
+def message_tokens(message: BaseMessage) -> int:
+    return count_tokens(str(message.content)) + _MESSAGE_OVERHEAD
+
+
+class PromptPacker():
+    """
+    Fit the chat history and the retrieved context into the prompt budget of a model, i.e. its context window
+    less `reserve` tokens left for the answer. The system prompt and the question always go in. Then come the
+    retrieved chunks by rank and the history from the latest message backwards, so that the earliest turns are
+    dropped first. Only when no history is left are the lowest ranked chunks dropped.
+    """
+
+    def __init__(self, logger, budget: int, reserve: int, system_prompt: str):
+        self.logger = logger
+        self.budget = budget
+        self.reserve = reserve
+        self.overhead = count_tokens(system_prompt) + _MESSAGE_OVERHEAD
+
+    def _room(self, question: str) -> int:
+        return max(0, self.budget - self.reserve) - self.overhead - count_tokens(question) - _MESSAGE_OVERHEAD
+
+    @staticmethod
+    def _latest(history: Sequence[BaseMessage], room: int) -> Tuple[List[BaseMessage], int]:
+        kept = []
+        for message in reversed(history):
+            n_tokens = message_tokens(message)
+            if n_tokens > room:
+                break
+            kept.append(message)
+            room -= n_tokens
+        # Do not start with an answer whose question was dropped.
+        while kept and kept[-1].type == 'ai':
+            room += message_tokens(kept.pop())
+        return kept[::-1], room
+
+    def pack(self, question: str, history: Sequence[BaseMessage],
+             context: Sequence[Document] = ()) -> Tuple[List[BaseMessage], List[Document], int]:
+        """
+        Return the history and context to send and the number of prompt tokens they make up with the rest.
+        """
+        room = self._room(question)
+        kept_context = []
+        for doc in context:
+            n_tokens = chunk_tokens(doc)
+            if n_tokens > room:
+                break
+            kept_context.append(doc)
+            room -= n_tokens
+        kept_history, room = self._latest(history, room)
+        n_tokens = self.budget - self.reserve - room
+        if len(kept_history) < len(history) or len(kept_context) < len(context):
+            self.logger.info(f'Fit the prompt into {n_tokens} tokens with {len(kept_history)}/{len(history)} '
+                             f'history messages and {len(kept_context)}/{len(context)} chunks.')
+        return kept_history, kept_context, n_tokens
@@ -1,6 +1,6 @@
-import os, sys
+import os, sys, re
 from pydantic import BaseModel
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Tuple
 from dotenv import load_dotenv, find_dotenv
 import toml
 import tomlkit  # Import tomlkit for round-trip parsing
@@ -150,6 +150,24 @@ class UniConfig():
     def get_robot_desc(self):
         return self.dcfg['Knowledge']['ROBOT_DESC']
 
+    def get_knowledge_bases(self)->Dict[str, Dict[str, Union[str, List[str], None]]]:
+        """
+        Return {knowledge base ID: {'documents': [...], 'robot_desc': str, 'docs_dir': str | None}}, starting with
+        the default knowledge base of [Knowledge]. Further ones are configured in [KnowledgeBases.<ID>].
+        """
+        knowledge_bases = {'default': {'documents': self.get_documents(), 'robot_desc': self.get_robot_desc(),
+                                       'docs_dir': None}}
+        for kb_id, kb in self.dcfg.get('KnowledgeBases', {}).items():
+            if not re.fullmatch(r'[A-Za-z0-9_-]+', kb_id) or kb_id in knowledge_bases:
+                self.logger.error(f'Knowledge base ID {kb_id} is invalid or taken and ignored. '
+                                  f'Use letters, digits, "_" and "-" only.')
+                continue
+            knowledge_bases[kb_id] = {
+                'documents': [d.strip() for d in kb.get('DOCUMENTS', '').split(',') if d.strip()],
+                'robot_desc': kb.get('ROBOT_DESC') or self.get_robot_desc(),
+                'docs_dir': kb.get('DOCS_DIR') or None}
+        return knowledge_bases
+
     def update_knowledge_base(self, doc_list: list|None = None, robot_desc: str|None = None):
         if doc_list or robot_desc:
             # Load the original TOML file with tomlkit to preserve structure and comments
@@ -197,6 +215,123 @@ class UniConfig():
             emb_model = None
         return emb_provider, emb_model
 
+    def retrieve_condenser_config(self)->Tuple[str | None, str | None]:
+        """
+        Return the provider and model condensing follow-up questions, or (None, None) to let the answering
+        LLM do it.
+        """
+        condenser = {**self.factory_cfg.get('Condenser', {}), **self.dcfg.get('Condenser', {})}
+        provider = condenser.get('CONDENSER_PROVIDER', '')
+        model = condenser.get('CONDENSER_MODEL', '')
+        if not provider:
+            return None, None
+        providers = {p.upper(): p for p in self.scfg['Providers'].keys()}
+        if provider.upper() not in providers:
+            self.logger.warning(f'Condenser provider {provider} is not supported. The LLM condenses questions instead.')
+            return None, None
+        model = model or self.scfg['Providers'][providers[provider.upper()]][f'{provider.upper()}_LLM_MODEL'].split(',')[0]
+        if provider.upper() == 'OLLAMA' and not check_model_avail(model):
+            self.logger.warning(f'Under Ollama, condenser model {model} is not locally found. '
+                                f'The LLM condenses questions instead.')
+            return None, None
+        self.logger.info(f'Condenser : {provider} {model}')
+        return provider, model
+
+    def get_condenser_bypass(self)->bool:
+        condenser = {**self.factory_cfg.get('Condenser', {}), **self.dcfg.get('Condenser', {})}
+        return bool(condenser.get('BYPASS', True))
+
+    def get_ingestion_config(self, emb_provider: str)->Tuple[int, int]:
+        defaults = self.scfg.get('Ingestion', {})
+        batch_size = int(defaults.get('EMB_BATCH_SIZE', 32))
+        concurrency = int(defaults.get('EMB_CONCURRENCY', 2))
+        for p, prov_cfg in self.scfg['Providers'].items():
+            if p.upper() == (emb_provider or '').upper():
+                batch_size = int(prov_cfg.get(f'{p.upper()}_EMB_BATCH_SIZE', batch_size))
+                concurrency = int(prov_cfg.get(f'{p.upper()}_EMB_CONCURRENCY', concurrency))
+        return batch_size, concurrency
+
+    def get_llm_concurrency(self, llm_provider: str)->int:
+        concurrency = int(self.scfg.get('Scheduler', {}).get('LLM_CONCURRENCY', 4))
+        for p, prov_cfg in self.scfg['Providers'].items():
+            if p.upper() == (llm_provider or '').upper():
+                concurrency = int(prov_cfg.get(f'{p.upper()}_LLM_CONCURRENCY', concurrency))
+        return concurrency
+
+    def get_session_config(self)->Dict[str, Union[bool, int]]:
+        sessions = self.scfg.get('Sessions', {})
+        return {'max_messages': int(sessions.get('MAX_MESSAGES', 128)),
+                'ttl': int(sessions.get('IDLE_TTL', 86400)),
+                'max_mb': int(sessions.get('MAX_MB', 64)),
+                'persistent': bool(sessions.get('PERSISTENT', True))}
+
+    def get_token_budget(self, llm_provider: str, llm_model: str)->Tuple[int, int]:
+        prompt = self.scfg.get('Prompt', {})
+        budget = int(prompt.get('TOKEN_BUDGET', 8192))
+        for p, prov_cfg in self.scfg['Providers'].items():
+            if p.upper() == (llm_provider or '').upper():
+                budget = int(prov_cfg.get(f'{p.upper()}_TOKEN_BUDGET', budget))
+        budget = int(prompt.get('Models', {}).get(llm_model, budget))
+        # Never leave less than half of the budget to the prompt.
+        return budget, min(int(prompt.get('ANSWER_RESERVE', 1024)), budget // 2)
+
+    def get_max_queue(self)->int:
+        return int(self.scfg.get('Scheduler', {}).get('MAX_QUEUE', 32))
+
+    def get_http_config(self)->Dict[str, Union[bool, int, float]]:
+        http = self.scfg.get('HttpClient', {})
+        return {'max_connections': int(http.get('MAX_CONNECTIONS', 20)),
+                'max_keepalive': int(http.get('MAX_KEEPALIVE', 10)),
+                'keepalive_expiry': float(http.get('KEEPALIVE_EXPIRY', 60)),
+                'http2': bool(http.get('HTTP2', True)),
+                'timeout': float(http.get('TIMEOUT', 600)),
+                'connect_timeout': float(http.get('CONNECT_TIMEOUT', 10))}
+
+    def get_chunk_params(self, doc_type: str)->Tuple[int, int]:
+        chunking = self.scfg.get('Chunking', {})
+        chunk_size = int(chunking.get(f'{doc_type.upper()}_CHUNK_SIZE', chunking.get('CHUNK_SIZE', 300)))
+        chunk_overlap = int(chunking.get(f'{doc_type.upper()}_CHUNK_OVERLAP', chunking.get('CHUNK_OVERLAP', 20)))
+        return chunk_size, chunk_overlap
+
+    def get_index_config(self)->Dict[str, Union[int, str]]:
+        index = self.scfg.get('Index', {})
+        return {'index_type': str(index.get('INDEX_TYPE', 'flat')).lower(),
+                'train_threshold': int(index.get('TRAIN_THRESHOLD', 20000)),
+                'nlist': int(index.get('NLIST', 0)),
+                'nprobe': int(index.get('NPROBE', 16)),
+                'hnsw_m': int(index.get('HNSW_M', 32)),
+                'ef_construction': int(index.get('EF_CONSTRUCTION', 80)),
+                'ef_search': int(index.get('EF_SEARCH', 64)),
+                'pq_m': int(index.get('PQ_M', 0)),
+                'vector_encoding': str(index.get('VECTOR_ENCODING', 'float32')).lower(),
+                'rerank': bool(index.get('RERANK', True)),
+                'rerank_factor': int(index.get('RERANK_FACTOR', 4))}
+
+    def get_retrieval_config(self)->Dict[str, Union[int, float]]:
+        # Older dynamic configs come without the section. Fall back to the factory one then.
+        retrieval = {**self.factory_cfg.get('Retrieval', {}), **self.dcfg.get('Retrieval', {})}
+        return {'k': int(retrieval.get('TOP_K', 3)),
+                'candidates': int(retrieval.get('CANDIDATES', 20)),
+                'vector_weight': float(retrieval.get('VECTOR_WEIGHT', 1.0)),
+                'lexical_weight': float(retrieval.get('LEXICAL_WEIGHT', 1.0)),
+                'rrf_k': int(retrieval.get('RRF_K', 60))}
+
+    def get_emb_cache_limit(self)->int:
+        return int(self.scfg.get('Cache', {}).get('EMB_CACHE_MAX_MB', 512))
+
+    def get_kb_cache_limit(self)->int:
+        return int(self.scfg.get('Cache', {}).get('KB_CACHE_MB', 1024))
+
+    def get_docstore_cache_size(self)->int:
+        return int(self.scfg.get('Cache', {}).get('DOCSTORE_CACHE_SIZE', 1024))
+
+    def get_answer_cache_config(self)->Dict[str, Union[bool, int, float]]:
+        cache = self.scfg.get('Cache', {})
+        return {'enabled': bool(cache.get('ANSWER_CACHE_ENABLED', True)),
+                'threshold': float(cache.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+                'ttl': int(cache.get('ANSWER_CACHE_TTL', 3600)),
+                'max_entries': int(cache.get('ANSWER_CACHE_SIZE', 512))}
+
     def santize(self):
         to_suspend = False
         llm_provider, llm_model = self.retrieve_llmconfig(verbose=False)
@@ -1,4 +1,6 @@
 import os
+import time
+from contextlib import contextmanager
 import psutil
 import ollama
 
@@ -25,3 +27,27 @@ def check_model_avail(model_name):
     model_names = [m.model for m in available_models.models]
     return model_name in model_names
 
+class PhaseTimer():
+    """
+    Accumulate the wall time of named phases, e.g. of the application startup, and log them as one report.
+    """
+
+    def __init__(self, logger, started: float | None = None):
+        self.logger = logger
+        self.started = time.perf_counter() if started is None else started
+        self.phases = {}  # name: seconds, in the order the phases were first seen
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self, title: str = 'Startup'):
+        phases = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.phases.items())
+        self.logger.info(f'{title} took {time.perf_counter() - self.started:.2f}s: {phases}')
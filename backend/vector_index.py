@@ -0,0 +1,118 @@
+import math
+from typing import Dict, Union
+import numpy as np
+
+# Vectors are always collected in a flat index while ingesting, since it needs no training and supports
+# deletion. The index served to searches is built from those vectors with the configured type.
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq')
+VECTOR_ENCODINGS = ('float32', 'float16', 'int8', 'pq')
+PQ_MIN_TRAIN = 256  # A PQ codebook has 256 centroids, each needing a training vector at least.
+
+
+def _pq_subquantizers(dim: int, pq_m: int) -> int:
+    if pq_m > 0 and dim % pq_m == 0:
+        return pq_m
+    # Aim at about 8 dimensions per sub-quantizer. The count has to divide the dimension.
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def index_spec(params: Dict[str, Union[int, str]], ntotal: int, dim: int) -> str:
+    """
+    Return the faiss index_factory string for the configured index type, vector encoding and corpus size.
+    Knowledge bases smaller than the training threshold get no ANN structure, where exact search is fast
+    enough anyway and there would be too few vectors to train on. The same goes for PQ codebooks, which
+    fall back to int8 below PQ_MIN_TRAIN vectors as well, however low the threshold is configured.
+    """
+    index_type = str(params.get('index_type', 'flat')).lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f'Index type {index_type} is unsupported. Choose one of {", ".join(INDEX_TYPES)}.')
+    encoding = str(params.get('vector_encoding', 'float32')).lower()
+    if encoding not in VECTOR_ENCODINGS:
+        raise ValueError(f'Vector encoding {encoding} is unsupported. Choose one of {", ".join(VECTOR_ENCODINGS)}.')
+    trainable = ntotal >= int(params.get('train_threshold', 20000))
+    if index_type == 'ivf_pq':
+        encoding = 'pq'
+    if encoding == 'pq' and not (trainable and ntotal >= PQ_MIN_TRAIN):
+        encoding = 'int8'
+    code = {'float32': 'Flat', 'float16': 'SQfp16', 'int8': 'SQ8',
+            'pq': f'PQ{_pq_subquantizers(dim, int(params.get("pq_m", 0)))}'}[encoding]
+    if index_type == 'flat' or not trainable:
+        return code
+    if index_type == 'hnsw':
+        return f'HNSW{int(params.get("hnsw_m", 32))}' + ('' if code == 'Flat' else f',{code}')
+    # k-means needs a training vector per centroid at least.
+    nlist = min(int(params.get('nlist', 0)) or int(4 * math.sqrt(ntotal)), ntotal)
+    return f'IVF{nlist},{code}'
+
+
+def is_lossy(spec: str) -> bool:
+    return 'SQ' in spec or 'PQ' in spec
+
+
+def build_index(vectors: np.ndarray, spec: str, params: Dict[str, Union[int, str]], logger):
+    import faiss
+    index = faiss.index_factory(vectors.shape[1], spec)
+    if not index.is_trained:
+        # A random sample of 256 vectors per centroid is plenty for k-means.
+        rng = np.random.default_rng(0)
+        centroids = faiss.extract_index_ivf(index).nlist if spec.startswith('IVF') else 256
+        sample_size = min(len(vectors), 256 * centroids)
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        logger.info(f'Train the {spec} index on {sample_size} vectors.')
+        index.train(sample)
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efConstruction = int(params.get('ef_construction', 80))
+    for i in range(0, len(vectors), 65536):
+        index.add(np.ascontiguousarray(vectors[i:i + 65536]))
+    if spec.startswith('IVF'):
+        # MMR reconstructs the candidates it re-ranks, which IVF indexes can do through a direct map only.
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index
+
+
+def tune_index(index, params: Dict[str, Union[int, str]]):
+    """
+    Apply the search-time parameters, i.e. nprobe of IVF indexes and efSearch of HNSW indexes.
+    """
+    import faiss
+    try:
+        faiss.extract_index_ivf(index).nprobe = int(params.get('nprobe', 16))
+    except RuntimeError:
+        pass  # Not an IVF index
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = int(params.get('ef_search', 64))
+
+
+class RefinedIndex():
+    """
+    Search a compressed index for `factor` times as many candidates as asked for and re-rank them by exact
+    L2 distance against the full-precision vectors. The vectors are memory-mapped from disk, so only the
+    pages of the candidates are read. Everything else is delegated to the wrapped index.
+    """
+
+    def __init__(self, index, vectors: np.ndarray, factor: int = 4):
+        self.index = index
+        self.vectors = vectors
+        self.factor = max(1, factor)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x: np.ndarray, k: int):
+        _, candidates = self.index.search(x, k * self.factor)
+        distances = np.full((len(x), k), np.inf, dtype=np.float32)
+        labels = np.full((len(x), k), -1, dtype=np.int64)
+        for row, ids in enumerate(candidates):
+            ids = np.sort(ids[ids >= 0])  # Ascending positions read the memory map sequentially.
+            exact = ((self.vectors[ids] - x[row]) ** 2).sum(axis=1)
+            best = np.argsort(exact)[:k]
+            distances[row, :len(best)] = exact[best]
+            labels[row, :len(best)] = ids[best]
+        return distances, labels
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.array(self.vectors[i], dtype=np.float32)
@@ -28,6 +28,18 @@ if (!sessionId) {
     sessionId = generateSessionId();
     sessionStorage.setItem('sessionId', sessionId);
 }
+// Knowledge base asked, e.g. index.html?kb=product-a. The default one if absent.
+const knowledgeBaseId = new URLSearchParams(window.location.search).get('kb');
+
+// Raised when the server turns a question away because too many are queued
+class BusyError extends Error {
+    constructor(retryAfter, position) {
+        super('Server busy');
+        this.retryAfter = retryAfter;
+        this.position = position;
+    }
+}
+
 function sendMessage() {
     const userInput = document.getElementById('user-input').value;
     if (userInput.trim() === "") return;
@@ -36,32 +48,72 @@ function sendMessage() {
 
     const data = {
         question: userInput,
-        session_id: sessionId
+        session_id: sessionId,
+        kb_id: knowledgeBaseId
+    };
+
+    // The answer is streamed in as server-sent events and rendered as it grows
+    let reply = null;
+    const texts = {reasoning: '', answer: ''};
+    const render = (event, text) => {
+        texts[event] += text;
+        if (!reply) {
+            reply = appendMessage('assistant', '');
+        }
+        if (event === 'reasoning') {
+            if (!reply.reasoningElement) {
+                reply.reasoningElement = document.createElement('div');
+                reply.reasoningElement.className = 'assistant reasoning';
+                reply.messageGroup.insertBefore(reply.reasoningElement, reply.messageElement);
+            }
+            reply.reasoningElement.innerHTML = marked.parse(texts.reasoning);
+        } else {
+            reply.messageElement.dataset.rawMarkdown = texts.answer;
+            reply.messageElement.innerHTML = marked.parse(texts.answer);
+        }
+        const chatBox = document.getElementById('chat-box');
+        chatBox.scrollTop = chatBox.scrollHeight;
     };
 
-    fetch(`${BASE_URL}/ask`, { // Use BASE_URL
+    fetch(`${BASE_URL}/ask/stream`, { // Use BASE_URL
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
         },
         body: JSON.stringify(data),
     })
-    .catch(error => {
-        console.error('Error during fetch:', error);
-    })
     .then(response => {
+        if (response.status === 503 && response.headers.get('Retry-After')) {
+            throw new RangeError(response.headers.get('Retry-After'));
+        }
+        if (response.status === 429) {
+            throw new BusyError(response.headers.get('Retry-After'), response.headers.get('X-Queue-Position'));
+        }
         if (!response.ok) {
             return response.text().then(errorText => {
                 throw new Error(`Server error: ${errorText}`);
             });
         }
-        return response.json();
-    })
-    .then(data => {
-        appendMessage('assistant', data.answer, think=data.think);
+        return readServerSentEvents(response, (event, data) => {
+            if (event === 'reasoning' || event === 'answer') {
+                render(event, data.text);
+            } else if (event === 'error') {
+                if (data.retry_after) {
+                    throw new BusyError(data.retry_after, null);
+                }
+                throw new Error(`Server error: ${data.detail}`);
+            }
+        });
     })
     .catch(error => {
-        if (error instanceof TypeError) {
+        if (error instanceof RangeError) {
+            // The knowledge base is still being built
+            appendMessage('assistant', `知识库正在加载，请${error.message}秒后再试。`);
+        } else if (error instanceof BusyError) {
+            // Too many questions are queued for the LLM
+            const position = error.position ? `您将排在第${error.position}位，` : '';
+            appendMessage('assistant', `当前提问人数过多，${position}请${error.retryAfter || 5}秒后再试。`);
+        } else if (error instanceof TypeError) {
             console.error('Network error:', error);
             appendMessage('assistant', '网络错误，请检查您的网络连接。');
         } else {
@@ -74,6 +126,33 @@ function sendMessage() {
     document.getElementById('user-input').focus();
 }
 
+// Read a text/event-stream response and pass each event with its JSON data to onEvent
+async function readServerSentEvents(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const {done, value} = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, {stream: true});
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            const dataLines = [];
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            }
+            onEvent(event, dataLines.length ? JSON.parse(dataLines.join('\n')) : {});
+        }
+    }
+}
+
 function appendMessage(sender, message, think=null) {
     const chatBox = document.getElementById('chat-box');
     const messageGroup = document.createElement('div');
@@ -137,6 +216,7 @@ function appendMessage(sender, message, think=null) {
     }
 //    chatBox.appendChild(messageGroup);
     chatBox.scrollTop = chatBox.scrollHeight;
+    return {messageGroup, messageElement};
 }
 
 function config_event_for_copy_button(messageElement, copyButton, dropdown) {
@@ -947,6 +1027,24 @@ function hideAwaitingStatus() {
     }
 }
 
+// Function to poll a knowledge base rebuild job until it is finished
+async function waitForRebuild(jobId) {
+    while (true) {
+        const response = await fetch(`${BASE_URL}/api/config-apply/${jobId}`, {method: 'GET'});
+        if (!response.ok) {
+            throw new Error(`Server error: ${await response.text()}`);
+        }
+        const job = await response.json();
+        if (job.state !== 'running') {
+            if (job.state === 'failed') {
+                console.error('Rebuild failed:', job.message);
+            }
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 // Function to apply configuration changes
 async function applyConfigChanges() {
     try {
@@ -962,7 +1060,9 @@ async function applyConfigChanges() {
             throw new Error(`Server error: ${await response.text()}`);
         }
         const data = await response.json();
-        if (data.status_ok) {
+        // The knowledge base is rebuilt in the background. Poll the job until it is swapped in.
+        const job = data.status_ok ? await waitForRebuild(data.job_id) : null;
+        if (job && job.state === 'done') {
             showCustomAlert('成功', '配置变更已成功应用。');
 
             // Reset the session ID
@@ -0,0 +1,43 @@
+from doc_loader import iter_markdown_sections
+
+
+def sections(tmp_path, text, encoding='utf-8'):
+    path = tmp_path / 'doc.md'
+    path.write_bytes(text.encode(encoding))
+    return list(iter_markdown_sections(str(path)))
+
+
+def test_sections_keep_the_heading_path(tmp_path):
+    docs = sections(tmp_path, '# FAQ\nIntro\n## Network\nCheck the cable.\n## Power\nPlug it in.\n# About\nUs\n')
+    assert [d.metadata['section'] for d in docs] == ['FAQ', 'FAQ > Network', 'FAQ > Power', 'About']
+    assert docs[1].page_content == '## Network\nCheck the cable.\n'
+
+
+def test_sections_record_line_and_offset(tmp_path):
+    text = 'Preamble\n# One\nbody\n# Two\nmore\n'
+    docs = sections(tmp_path, text)
+    assert [d.metadata['line'] for d in docs] == [1, 2, 4]
+    assert [text[d.metadata['offset']:].startswith(d.page_content) for d in docs] == [True, True, True]
+    assert docs[0].metadata['section'] == ''
+
+
+def test_setext_headings(tmp_path):
+    docs = sections(tmp_path, 'Title\n=====\ntext\nSub\n---\nmore\n')
+    assert [d.metadata['section'] for d in docs] == ['Title', 'Title > Sub']
+    assert docs[1].page_content == 'Sub\n---\nmore\n'
+
+
+def test_headings_in_code_blocks_are_ignored(tmp_path):
+    docs = sections(tmp_path, '# Shell\n```\n# a comment\n```\n')
+    assert len(docs) == 1
+    assert docs[0].metadata['section'] == 'Shell'
+
+
+def test_blank_preamble_is_skipped(tmp_path):
+    docs = sections(tmp_path, '\n\n# B\ntext\n')
+    assert [d.metadata['section'] for d in docs] == ['B']
+
+
+def test_sections_concatenate_to_the_file(tmp_path):
+    text = '# 常见问题\r\n问：如何重置？\r\n## 网络\r\n答：重启路由器。\r\n'
+    assert ''.join(d.page_content for d in sections(tmp_path, text)) == text
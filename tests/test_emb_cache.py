@@ -0,0 +1,76 @@
+import logging
+import pytest
+from langchain_core.embeddings import Embeddings
+import emb_cache
+from emb_cache import EmbeddingCache, CachedEmbeddings
+
+logger = logging.getLogger(__name__)
+VECTOR_BYTES = 16  # Four float32
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t)), 0.0, 0.0, 1.0] for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # A tick per call, so that the least recently used entry is well defined.
+    monkeypatch.setattr(emb_cache.time, 'time', Clock().time)
+
+
+def vector(x: float):
+    return [x, 0.0, 0.0, 0.0]
+
+
+def test_vectors_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), logger)
+    cache.put_many('OLLAMA', 'bge-m3', {'h1': vector(1.5)})
+    assert cache.get_many('OLLAMA', 'bge-m3', ['h1', 'h2']) == {'h1': vector(1.5)}
+    assert cache.get_many('OLLAMA', 'other', ['h1']) == {}
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), logger)
+    cache.max_bytes = 3 * VECTOR_BYTES
+    cache.put_many('P', 'm', {'a': vector(1), 'b': vector(2)})
+    cache.put_many('P', 'm', {'c': vector(3)})
+    cache.get_many('P', 'm', ['a'])  # 'b' is the least recently used now
+    cache.put_many('P', 'm', {'d': vector(4)})
+    # Eviction goes down to 90% of the limit, which takes 'c' as well.
+    assert sorted(cache.get_many('P', 'm', ['a', 'b', 'c', 'd'])) == ['a', 'd']
+    assert cache._size == 2 * VECTOR_BYTES
+
+
+def test_size_survives_replacement_and_reopening(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), logger)
+    cache.put_many('P', 'm', {'a': vector(1), 'b': vector(2)})
+    cache.put_many('P', 'm', {'a': vector(5)})
+    assert cache._size == 2 * VECTOR_BYTES
+    assert EmbeddingCache(str(tmp_path), logger)._size == 2 * VECTOR_BYTES
+
+
+def test_only_new_texts_are_embedded(tmp_path):
+    client = CountingEmbeddings()
+    embeddings = CachedEmbeddings(client, EmbeddingCache(str(tmp_path), logger), 'ollama', 'bge-m3')
+    first = embeddings.embed_documents(['one', 'two', 'one'])
+    second = embeddings.embed_documents(['two', 'three'])
+    assert client.calls == [['one', 'two'], ['three']]
+    assert first[0] == first[2] and second[0] == first[1]
+    assert (embeddings.hits, embeddings.misses) == (1, 3)
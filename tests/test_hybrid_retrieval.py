@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+from lexical_index import BM25Index, tokenize
+from retrievers import HybridRetriever
+
+TEXTS = {
+    'c1': 'UniChat answers questions about your documents.',
+    'c2': 'The HX-200 router supports WiFi 6.',
+    'c3': '本地模型通过 Ollama 运行。',
+    'c4': 'Restart the router if the network is down.',
+}
+
+
+def bm25() -> BM25Index:
+    return BM25Index(list(TEXTS), list(TEXTS.values()))
+
+
+def hybrid(index: BM25Index | None = None, **fields) -> HybridRetriever:
+    docstore = InMemoryDocstore({i: Document(id=i, page_content=t) for i, t in TEXTS.items()})
+    # No vector store behind it. The vector hits are handed to _fuse directly.
+    return HybridRetriever.model_construct(lexical_index=index or bm25(), docstore=docstore,
+                                           lock=threading.RLock(), **fields)
+
+
+def test_tokenize_codes_and_cjk():
+    assert tokenize('HX-200') == ['hx-200', 'hx200', 'hx', '200']
+    assert tokenize('本地模型') == ['本地', '地模', '模型']
+
+
+def test_bm25_ranks_matching_chunks():
+    hits = bm25().search('router network', 10)
+    assert [chunk_id for chunk_id, _ in hits] == ['c4', 'c2']
+    assert bm25().search('hx200', 10)[0][0] == 'c2'
+    assert bm25().search('模型', 10)[0][0] == 'c3'
+    assert bm25().search('nothing matches', 10) == []
+
+
+def test_fusion_favours_chunks_both_searches_found():
+    retriever = hybrid(k=2)
+    docs = retriever._fuse(['c1', 'c4', 'c3'], [('c4', 3.0), ('c2', 1.0)])
+    assert [d.id for d in docs] == ['c4', 'c1']
+
+
+def test_fusion_weights():
+    retriever = hybrid(k=1, vector_weight=1.0, lexical_weight=3.0)
+    assert [d.id for d in retriever._fuse(['c1'], [('c2', 1.0)])] == ['c2']
+
+
+def test_fusion_skips_deleted_chunks():
+    retriever = hybrid(k=2)
+    retriever.docstore.delete(['c1'])
+    assert [d.id for d in retriever._fuse(['c1', 'c3'], [('c4', 1.0)])] == ['c4', 'c3']
+
+
+def test_keyword_search_alone():
+    retriever = hybrid(k=2, vector_weight=0.0)
+    docs = asyncio.run(retriever.aget_by_vector('HX-200 router', None))
+    assert [d.id for d in docs] == ['c2', 'c4']
@@ -0,0 +1,38 @@
+import hashlib
+from index_store import IndexStore
+
+TEXTS = ['Intro', 'Setup', 'FAQ', 'Setup']
+
+
+def test_chunk_ids_are_stable():
+    ids = IndexStore.chunk_ids('guide.md', TEXTS)
+    assert ids == IndexStore.chunk_ids('guide.md', TEXTS)
+    assert len(set(ids)) == len(TEXTS)  # Repeated chunks get IDs of their own.
+    # Persisted manifests hold these IDs, so their derivation must not change.
+    assert ids[3] == hashlib.sha256('guide.md\x001\x00Setup'.encode('utf-8')).hexdigest()[:32]
+
+
+def test_chunk_ids_do_not_depend_on_positions():
+    ids = dict(zip(TEXTS[:3], IndexStore.chunk_ids('guide.md', TEXTS[:3])))
+    edited = IndexStore.chunk_ids('guide.md', ['New intro', 'Setup', 'FAQ'])
+    assert edited[1:] == [ids['Setup'], ids['FAQ']]
+
+
+def test_chunk_ids_across_batches():
+    seen = {}
+    batched = IndexStore.chunk_ids('guide.md', TEXTS[:2], seen) + IndexStore.chunk_ids('guide.md', TEXTS[2:], seen)
+    assert batched == IndexStore.chunk_ids('guide.md', TEXTS)
+    assert all(isinstance(key, bytes) for key in seen)  # Digests, not the chunk text
+
+
+def test_chunk_ids_differ_between_documents():
+    assert set(IndexStore.chunk_ids('a.md', TEXTS)).isdisjoint(IndexStore.chunk_ids('b.md', TEXTS))
+
+
+def test_store_key_follows_the_embedding_setting():
+    params = {'chunk_size': 512, 'chunk_overlap': 64}
+    store = IndexStore('/unused', None)
+    key = store.store_key(params, 'ollama', 'bge-m3')
+    assert key == store.store_key(dict(params), 'OLLAMA', 'bge-m3')
+    assert key != store.store_key(params, 'ollama', 'nomic-embed-text')
+    assert store.store_key(params, 'ollama', 'bge-m3', 'manuals') == f'manuals.{key}'
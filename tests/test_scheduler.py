@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import pytest
+from scheduler import RequestScheduler, SchedulerBusy
+
+logger = logging.getLogger(__name__)
+
+
+def scheduler(concurrency: int = 1, max_queue: int = 1) -> RequestScheduler:
+    return RequestScheduler(logger, lambda provider: concurrency, max_queue)
+
+
+def test_concurrency_per_provider():
+    sched = scheduler(concurrency=2, max_queue=8)
+    running, peak = 0, 0
+
+    async def ask(provider):
+        nonlocal running, peak
+        async with sched.slot(provider):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    async def main():
+        await asyncio.gather(*(ask('ollama') for _ in range(6)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert sched.stats()['providers']['OLLAMA']['running'] == 0
+
+
+def test_full_queue_is_turned_away():
+    sched = scheduler(concurrency=1, max_queue=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def hold():
+            async with sched.slot('openai'):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy) as busy:
+            sched.check('openai')
+        release.set()
+        await asyncio.gather(holder, waiter)
+        sched.check('openai')  # Room again
+        return busy.value
+
+    busy = asyncio.run(main())
+    assert busy.position == 2
+    assert busy.retry_after >= 1
+    assert sched.rejected == 1
+
+
+def test_identical_requests_share_a_generation():
+    sched = scheduler()
+
+    async def main():
+        async with sched.lead('key') as future:
+            follower = sched.join('key')
+            assert follower is future
+            future.set_result('answer')
+        assert sched.join('key') is None
+        return await asyncio.shield(follower)
+
+    assert asyncio.run(main()) == 'answer'
+    assert sched.coalesced == 1
+
+
+def test_followers_get_the_failure_of_the_leader():
+    sched = scheduler()
+
+    async def main():
+        follower = None
+        with pytest.raises(ValueError):
+            async with sched.lead('key'):
+                follower = sched.join('key')
+                raise ValueError('LLM down')
+        with pytest.raises(ValueError):
+            await follower
+
+    asyncio.run(main())
+
+
+def test_requests_without_key_are_not_shared():
+    sched = scheduler()
+
+    async def main():
+        async with sched.lead(None) as future:
+            assert sched.join(None) is None
+            future.set_result('answer')
+
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+from knowledge_base import KnowledgeBase
+from rag_service import RagService
+
+
+def kb(kb_id: str) -> KnowledgeBase:
+    return KnowledgeBase(kb_id, '', [], '')
+
+
+def test_default_sessions_do_not_collide_with_other_knowledge_bases():
+    assert RagService._session_key('x:y', kb(KnowledgeBase.default_id)) != RagService._session_key('y', kb('x'))
+    assert RagService._session_key('a\\:b') != RagService._session_key('a:b')
+
+
+def test_plain_session_ids_are_kept():
+    assert RagService._session_key('abc') == 'abc'
+    assert RagService._session_key('abc', kb('manuals')) == 'manuals:abc'
+
+
+def test_every_knowledge_base_has_its_own_history():
+    keys = {RagService._session_key('s', kb(kb_id)) for kb_id in ('default', 'a', 'b', 'a:s')}
+    assert len(keys) == 4
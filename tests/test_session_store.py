@@ -0,0 +1,96 @@
+import logging
+import pytest
+from langchain_core.messages import HumanMessage, AIMessage
+import session_store
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, 'time', clock.time)
+    return clock
+
+
+def turn(history, question='q' * 10, answer='a' * 10):
+    history.add_messages([HumanMessage(content=question), AIMessage(content=answer)])
+
+
+def test_history_keeps_the_latest_messages():
+    store = SessionStore(logger, max_messages=4)
+    history = store.get('s')
+    for i in range(3):
+        turn(history, f'q{i}', f'a{i}')
+    assert [m.content for m in store.get('s').messages] == ['q1', 'a1', 'q2', 'a2']
+    assert store.stats()['bytes'] == 8
+
+
+def test_least_recently_used_sessions_are_let_go():
+    store = SessionStore(logger)
+    store.max_bytes = 50
+    for session_id in ('a', 'b', 'c'):
+        turn(store.get(session_id))  # 20 bytes each
+    assert store.stats() == {'persistent': False, 'sessions': 2, 'bytes': 40}
+    assert 'a' not in store
+    assert store.get('a').messages == []  # Lost without a database
+
+
+def test_session_in_use_stays_however_large():
+    store = SessionStore(logger)
+    store.max_bytes = 10
+    turn(store.get('a'), 'q' * 100)
+    assert 'a' in store
+
+
+def test_idle_sessions_expire(clock):
+    store = SessionStore(logger, ttl=600)
+    turn(store.get('old'))
+    clock.now += 500
+    turn(store.get('recent'))
+    clock.now += store.expire_interval + 200
+    store.get('other')
+    assert 'old' not in store
+    assert 'recent' in store
+
+
+def test_sessions_are_read_back_from_disk(tmp_path):
+    db_path = str(tmp_path / 'sessions.sqlite')
+    store = SessionStore(logger, db_path=db_path)
+    store.max_bytes = 30
+    turn(store.get('a'), 'first', 'answer')
+    turn(store.get('b'))
+    assert len(store) == 1
+    assert [m.content for m in store.get('a').messages] == ['first', 'answer']
+    store.close()
+    assert [m.content for m in SessionStore(logger, db_path=db_path).get('a').messages] == ['first', 'answer']
+
+
+def test_expired_sessions_are_deleted_from_disk(tmp_path, clock):
+    db_path = str(tmp_path / 'sessions.sqlite')
+    store = SessionStore(logger, ttl=600, db_path=db_path)
+    turn(store.get('a'))
+    store.close()
+    clock.now += 601
+    assert 'a' not in SessionStore(logger, ttl=600, db_path=db_path)
+
+
+def test_answer_appended_after_eviction_is_kept():
+    store = SessionStore(logger)
+    store.max_bytes = 30
+    history = store.get('a')
+    turn(history)
+    turn(store.get('b'))  # Lets 'a' go while its next answer is generated
+    assert 'a' not in store
+    turn(history, 'next', 'reply')
+    assert 'a' in store
+    assert [m.content for m in store.get('a').messages][-2:] == ['next', 'reply']
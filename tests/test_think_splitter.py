@@ -0,0 +1,52 @@
+import pytest
+from conversation import ThinkSplitter
+
+REASONING, ANSWER = ThinkSplitter.REASONING, ThinkSplitter.ANSWER
+
+
+def stream(chunks):
+    splitter = ThinkSplitter()
+    parts = []
+    for chunk in chunks:
+        parts.extend(splitter.feed(chunk))
+    parts.extend(splitter.finish())
+    return parts
+
+
+def joined(parts):
+    text = {REASONING: '', ANSWER: ''}
+    for state, part in parts:
+        text[state] += part
+    return text[REASONING], text[ANSWER]
+
+
+def test_split_complete_output():
+    assert ThinkSplitter.split('<think>\nLet me see.\n</think>\n\nIt is 42.') == ('It is 42.', 'Let me see.')
+
+
+def test_split_output_without_reasoning():
+    assert ThinkSplitter.split('  Just the answer. ') == ('Just the answer.', '')
+
+
+def test_split_joins_reasoning_blocks():
+    assert ThinkSplitter.split('<think>a</think>b<think>c</think>d') == ('bd', 'a\nc')
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7])
+def test_tags_split_across_chunks(size):
+    text = '<think>Weigh the options.</think>Take the train.'
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert joined(stream(chunks)) == ('Weigh the options.', 'Take the train.')
+
+
+def test_leading_whitespace_of_parts_is_dropped():
+    assert stream(['<think>', '\n  ', 'hmm', '</think>', '\n\n', 'Yes']) == [(REASONING, 'hmm'), (ANSWER, 'Yes')]
+
+
+def test_text_resembling_a_tag_is_released():
+    assert joined(stream(['a <', 'b', ' c <thi'])) == ('', 'a <b c <thi')
+
+
+def test_answer_is_streamed_before_the_output_ends():
+    splitter = ThinkSplitter()
+    assert splitter.feed('<think>x</think>Hello') == [(REASONING, 'x'), (ANSWER, 'Hello')]
@@ -0,0 +1,58 @@
+import logging
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import HumanMessage, AIMessage
+import token_budget
+from token_budget import PromptPacker, count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def estimate_by_characters(monkeypatch):
+    # Keep the counts independent of whether the tiktoken encoding is cached on this machine.
+    monkeypatch.setattr(token_budget, '_encoding', False)
+
+
+def chunk(n_tokens: int) -> Document:
+    return Document(page_content='x', metadata={'n_tokens': n_tokens})
+
+
+def turns(n: int):
+    # 'a' * 40 is estimated at 10 tokens, i.e. 14 with the message overhead.
+    return [(HumanMessage if i % 2 == 0 else AIMessage)(content='a' * 40) for i in range(n)]
+
+
+def test_character_estimate():
+    assert count_tokens('abcdefgh') == 2
+    assert count_tokens('知识库') == 3
+
+
+def test_everything_fits():
+    packer = PromptPacker(logger, 10000, 1000, 'You are helpful.')
+    history, context = turns(4), [chunk(20), chunk(20)]
+    assert packer.pack('Why?', history, context)[:2] == (history, context)
+
+
+def test_earliest_turns_go_first():
+    # Room for the prompt: 100 - 20 reserved - 4 system - 5 question = 71, less 22 for the chunk.
+    packer = PromptPacker(logger, 100, 20, '')
+    history = turns(4)
+    kept_history, kept_context, n_tokens = packer.pack('qqqq', history, [chunk(20)])
+    # Three messages would fit, but the history does not start with an orphaned answer.
+    assert kept_history == history[2:]
+    assert len(kept_context) == 1
+    assert n_tokens == 4 + 5 + 22 + 2 * 14
+
+
+def test_lowest_ranked_chunks_go_last():
+    packer = PromptPacker(logger, 100, 20, '')
+    context = [chunk(30), chunk(30), chunk(30)]
+    kept_history, kept_context, _ = packer.pack('qqqq', turns(2), context)
+    assert kept_history == []
+    assert kept_context == context[:2]
+
+
+def test_budget_smaller_than_the_question():
+    packer = PromptPacker(logger, 10, 20, '')
+    assert packer.pack('qqqq', turns(2), [chunk(1)])[:2] == ([], [])
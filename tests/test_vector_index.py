@@ -0,0 +1,52 @@
+import logging
+import numpy as np
+import pytest
+from vector_index import INDEX_TYPES, VECTOR_ENCODINGS, index_spec, build_index, is_lossy, RefinedIndex
+
+faiss = pytest.importorskip('faiss')
+
+logger = logging.getLogger(__name__)
+DIM = 16
+
+
+def vectors(n: int) -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((n, DIM)).astype(np.float32)
+
+
+def test_small_corpus_is_searched_exactly():
+    assert index_spec({'index_type': 'hnsw'}, 100, DIM) == 'Flat'
+    assert index_spec({'index_type': 'ivf_pq'}, 100, DIM) == 'SQ8'
+    assert index_spec({'vector_encoding': 'float16'}, 100, DIM) == 'SQfp16'
+
+
+def test_large_corpus_gets_the_configured_structure():
+    params = {'train_threshold': 1000}
+    assert index_spec(dict(params, index_type='ivf_flat'), 10000, DIM) == 'IVF400,Flat'
+    assert index_spec(dict(params, index_type='hnsw', vector_encoding='int8'), 10000, DIM) == 'HNSW32,SQ8'
+    assert index_spec(dict(params, index_type='ivf_pq'), 10000, DIM) == 'IVF400,PQ2'
+    assert index_spec(dict(params, vector_encoding='pq', pq_m=4), 10000, DIM) == 'PQ4'
+
+
+def test_pq_needs_a_codebook_worth_of_vectors():
+    params = {'train_threshold': 10, 'vector_encoding': 'pq'}
+    assert index_spec(params, 40, DIM) == 'SQ8'
+    assert index_spec(params, 256, DIM) == 'PQ2'
+
+
+def test_nlist_does_not_exceed_the_corpus():
+    assert index_spec({'index_type': 'ivf_flat', 'train_threshold': 10, 'nlist': 100}, 40, DIM) == 'IVF40,Flat'
+
+
+@pytest.mark.parametrize('ntotal', [40, 300])
+@pytest.mark.parametrize('encoding', VECTOR_ENCODINGS)
+@pytest.mark.parametrize('index_type', INDEX_TYPES)
+def test_build_and_search(index_type, encoding, ntotal):
+    params = {'index_type': index_type, 'vector_encoding': encoding, 'train_threshold': 10}
+    data = vectors(ntotal)
+    spec = index_spec(params, ntotal, DIM)
+    index = build_index(data, spec, params, logger)
+    assert index.ntotal == ntotal
+    if is_lossy(spec):
+        index = RefinedIndex(index, data)
+    _, labels = index.search(data[:5], 1)
+    assert labels[:, 0].tolist() == [0, 1, 2, 3, 4]